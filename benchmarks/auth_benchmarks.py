@@ -0,0 +1,204 @@
+"""Benchmarks of the auth hot paths (login, pages that verify the session, registration, e-mail verification and the
+unverified users cron). The app from main.py is driven through Flask's test client, with the in-memory Datastore as
+storage (see models/memory_datastore.py), so the numbers show the app itself rather than the emulator:
+
+    python -m benchmarks.auth_benchmarks --users 200 --sessions 3 --iterations 200 --output results.json
+
+To measure with the Datastore emulator instead (the same one the TESTING mode uses, on port 8002):
+
+    gcloud beta emulators datastore start --consistency=1 --no-store-on-disk --project test --host-port localhost:8002
+    DATASTORE_BACKEND=emulator python -m benchmarks.auth_benchmarks
+
+Results (requests per second, p50/p99/mean latency in milliseconds) are printed as JSON, so runs can be compared.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# the app connects to the storage when it's imported, so the environment has to be ready first
+os.environ.setdefault("TESTING", "yes")
+os.environ.setdefault("DATASTORE_BACKEND", "memory")
+# a low bcrypt cost, so the numbers show the rest of the request (bcrypt itself: python -m utils.password_policy)
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+from google.cloud import ndb  # noqa: E402
+
+from main import app  # noqa: E402
+from models import db_context, unit_of_work  # noqa: E402
+from models.one_time_code import OneTimeCode  # noqa: E402
+from models.user import User  # noqa: E402
+from utils import local_task_queue, rate_limit  # noqa: E402
+from utils.password_helper import hash_password  # noqa: E402
+
+
+PASSWORD = "benchmark-password"
+SESSION_COOKIE = "my-simple-app-session"
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+# calls request(index) "iterations" times (from "concurrency" threads) and returns the statistics
+def measure(request, iterations, concurrency):
+    latencies = []
+    errors = 0
+
+    def run(index):
+        started = time.perf_counter()
+        ok = request(index)
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for latency, ok in executor.map(run, range(iterations)):
+            latencies.append(latency)
+            errors += 0 if ok else 1
+    duration = time.perf_counter() - started
+
+    return {
+        "iterations": iterations,
+        "errors": errors,
+        "requests_per_second": round(iterations / duration, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+    }
+
+
+# creates verified users (with "sessions" sessions each) and returns their e-mails and session cookies
+def create_users(prefix, count, sessions, verified=True, batch_size=100):
+    password_hash = hash_password(PASSWORD)
+    emails = ["{0}-{1}@benchmark.test".format(prefix, index) for index in range(count)]
+    cookies = []
+
+    for start in range(0, count, batch_size):
+        # sessions are generated in a request, so all of them are written with one put_multi (see unit_of_work)
+        with app.test_request_context("/", environ_base={"REMOTE_ADDR": "127.0.0.1"}), db_context():
+            users = [User(id=email, email=email, password=password_hash, verified=verified)
+                     for email in emails[start:start + batch_size]]
+            ndb.put_multi(users)
+
+            for user in users:
+                cookies.append([User.generate_session(user) for _ in range(sessions)])
+
+            unit_of_work.flush()
+
+    return emails, cookies
+
+
+# creates unverified users with verification codes (expired ones, if hours is negative) and returns the codes
+def create_unverified_users(prefix, count, hours=24):
+    emails, _ = create_users(prefix, count, sessions=0, verified=False)
+
+    with db_context():
+        return [OneTimeCode.create(User.get_by_id(email), OneTimeCode.VERIFICATION, hours=hours) for email in emails]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100, help="number of users in the Datastore")
+    parser.add_argument("--sessions", type=int, default=3, help="number of sessions per user")
+    parser.add_argument("--iterations", type=int, default=100, help="number of requests per benchmark")
+    parser.add_argument("--concurrency", type=int, default=1, help="number of requests sent at the same time")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)  # the local e-mail task logs every e-mail
+
+    # the benchmark logs in as the same users over and over, which the rate limit would (rightly) reject
+    rate_limit.LIMITS = {action: {name: (10 ** 9, 1) for name in limits}
+                         for action, limits in rate_limit.LIMITS.items()}
+
+    prefix = uuid.uuid4().hex[:8]  # every run has its own users, so runs on the same emulator don't interfere
+    test_client = app.test_client(use_cookies=False)
+
+    emails, cookies = create_users(prefix, args.users, args.sessions)
+
+    def login(index):
+        response = test_client.post("/", data={"email": emails[index % len(emails)], "password": PASSWORD})
+        return response.status_code == 302
+
+    def guarded_page(path):
+        def request(index):
+            user_cookies = cookies[index % len(cookies)]
+            cookie = user_cookies[index % len(user_cookies)]
+            response = test_client.get(path, headers={"Cookie": "{0}={1}".format(SESSION_COOKIE, cookie)})
+
+            # error pages have status 200 too, but only pages of logged in users show their e-mail
+            return response.status_code == 200 and emails[index % len(emails)].encode() in response.data
+
+        return request
+
+    def registration(index):
+        email = "{0}-registration-{1}@benchmark.test".format(prefix, index)
+        response = test_client.post("/registration", data={"email": email, "password": PASSWORD})
+        return response.status_code == 200 and b"Verify your e-mail" in response.data
+
+    verification_codes = create_unverified_users(prefix + "-verification", args.iterations)
+
+    def email_verification(index):
+        response = test_client.get("/email-verification/" + verification_codes[index])
+        return response.status_code == 200 and b"Registration successfull" in response.data
+
+    results = {}
+
+    if args.sessions:
+        results["verify_session_home"] = measure(guarded_page("/"), args.iterations, args.concurrency)
+        results["verify_session_users_list"] = measure(guarded_page("/admin/users"), args.iterations,
+                                                       args.concurrency)
+
+    results["login"] = measure(login, args.iterations, args.concurrency)
+    results["registration"] = measure(registration, args.iterations, args.concurrency)
+    results["email_verification"] = measure(email_verification, args.iterations, args.concurrency)
+
+    # the cron removes all users whose verification code has expired (runs once, over "users" such users)
+    create_unverified_users(prefix + "-unverified", args.users, hours=-1)
+
+    started = time.perf_counter()
+    response = test_client.get("/cron/remove_unverified_users_cron")
+    results["remove_unverified_users_cron"] = {
+        "users": args.users,
+        "errors": 0 if response.status_code == 200 else 1,
+        "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+        "response": response.get_data(as_text=True),
+    }
+
+    local_task_queue.join(timeout=60)  # e-mails of the registrations
+
+    report = {
+        "date": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "config": {
+            "users": args.users,
+            "sessions": args.sessions,
+            "iterations": args.iterations,
+            "concurrency": args.concurrency,
+            "datastore_backend": os.environ["DATASTORE_BACKEND"],
+            "session_storage": os.environ.get("SESSION_STORAGE", "embedded"),
+            "session_claims": os.environ.get("SESSION_CLAIMS", "false"),
+            "bcrypt_rounds": int(os.environ["BCRYPT_ROUNDS"]),
+        },
+        "results": results,
+    }
+
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+    return 0 if all(result["errors"] == 0 for result in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
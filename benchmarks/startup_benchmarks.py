@@ -0,0 +1,138 @@
+"""Cold start benchmark: starts fresh Python processes that import main.py (like a new GAE instance does) and serve
+one request, and reports how long the import and the first request took, together with the import tree of the
+slowest modules (from python -X importtime):
+
+    python -m benchmarks.startup_benchmarks --runs 5 --min-ms 5 --output startup.json
+
+The import tree is printed to stderr, the results (milliseconds, min/median/max over the runs) as JSON to stdout, so
+runs before and after a change can be compared. The app uses the in-memory Datastore (DATASTORE_BACKEND=memory), so
+no emulator is needed.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+
+
+# runs in every started process: imports the app and sends it the first request
+CHILD_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+response = main.app.test_client().get({path!r})
+finished = time.perf_counter()
+print(json.dumps({{"import_ms": (imported - started) * 1000, "first_request_ms": (finished - imported) * 1000,
+                  "status": response.status_code}}))
+"""
+
+
+# parses the -X importtime output into a tree (importtime lists every module after the modules it imported)
+def parse_import_tree(output):
+    pending = {}  # depth: modules whose parent hasn't been listed yet
+
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+
+        module = {
+            "module": name.strip(),
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000,
+            "imports": pending.pop(depth + 1, []),
+        }
+        pending.setdefault(depth, []).append(module)
+
+    return pending.get(0, [])
+
+
+# returns the modules (and the modules they imported) that took at least min_ms, depth first
+def flatten_import_tree(modules, min_ms, depth=0):
+    rows = []
+
+    for module in sorted(modules, key=lambda item: item["cumulative_ms"], reverse=True):
+        if module["cumulative_ms"] < min_ms:
+            continue
+
+        rows.append({"module": module["module"], "depth": depth, "self_ms": round(module["self_ms"], 3),
+                     "cumulative_ms": round(module["cumulative_ms"], 3)})
+        rows += flatten_import_tree(module["imports"], min_ms, depth + 1)
+
+    return rows
+
+
+def start_instance(path):
+    env = dict(os.environ)
+    env.setdefault("TESTING", "yes")
+    env.setdefault("DATASTORE_BACKEND", "memory")
+    env.setdefault("BCRYPT_ROUNDS", "4")  # otherwise the first request may benchmark bcrypt (utils/password_policy.py)
+
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD_SCRIPT.format(path=path)], env=env,
+                             cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), capture_output=True,
+                             text=True, timeout=300)
+
+    if process.returncode != 0:
+        raise RuntimeError("The instance could not start:\n" + process.stderr[-3000:])
+
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    result["imports"] = parse_import_tree(process.stderr)
+
+    return result
+
+
+def summary(values):
+    return {"min": round(min(values), 3), "median": round(statistics.median(values), 3), "max": round(max(values), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="number of started processes")
+    parser.add_argument("--path", default="/", help="path of the first request")
+    parser.add_argument("--min-ms", type=float, default=5, help="only list imports that took at least this long")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    runs = [start_instance(args.path) for _ in range(args.runs)]
+
+    # the import tree of the run with the median import time
+    median_run = sorted(runs, key=lambda run: run["import_ms"])[len(runs) // 2]
+    imports = flatten_import_tree(median_run["imports"], args.min_ms)
+
+    for row in imports:
+        print("{0:>10.1f} ms  {1}{2}".format(row["cumulative_ms"], "  " * row["depth"], row["module"]),
+              file=sys.stderr)
+
+    report = {
+        "date": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "config": {
+            "runs": args.runs,
+            "path": args.path,
+            "datastore_backend": os.environ.get("DATASTORE_BACKEND", "memory"),
+        },
+        "results": {
+            "import_main_ms": summary([run["import_ms"] for run in runs]),
+            "first_request_ms": summary([run["first_request_ms"] for run in runs]),
+            "first_request_status": median_run["status"],
+            "imports": imports,
+        },
+    }
+
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+    return 0 if all(run["status"] == 200 for run in runs) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,12 @@
+from flask import request
+
+from models.one_time_code import OneTimeCode
+from utils.environment import is_local
+
+
+def remove_expired_codes_cron():
+    # only run this cron if it was called by the GAE Cron Service (header X-AppEngine-Cron) or if it's on
+    # localhost (tests)
+    if request.headers.get("X-AppEngine-Cron") or is_local():
+        OneTimeCode.delete_expired()
+        return "Success"
@@ -0,0 +1,33 @@
+import json
+import logging
+from flask import request, url_for
+
+from models.user import User
+from utils.environment import is_local
+from utils.task_helper import run_background_task
+
+
+# how long one run of this cron may compact users (in seconds); if there are more users left, the cron continues in a
+# background task
+TIME_BUDGET = 60
+
+
+def remove_expired_sessions_cron():
+    # only run this cron if it was called by the GAE Cron Service (header X-AppEngine-Cron), by itself as a Cloud Tasks
+    # task (header X-AppEngine-QueueName, with the cursor in the request body) or if it's on localhost (tests)
+    if request.headers.get("X-AppEngine-Cron") or request.headers.get("X-AppEngine-QueueName") or is_local():
+        data = json.loads(request.get_data(as_text=True) or "{}")
+
+        compacted, reclaimed, deleted, next_cursor, more = User.remove_expired_sessions(cursor=data.get("cursor"),
+                                                                                        time_budget=TIME_BUDGET)
+
+        message = "Removed expired sessions from {0} users (about {1} bytes reclaimed) and deleted {2} expired " \
+                  "session entities".format(compacted, reclaimed, deleted)
+        logging.info(message + (" (continuing)." if more else "."))
+
+        # the cursor is None if the time ran out while deleting Session entities (they are queried again anyway)
+        if more:
+            run_background_task(relative_path=url_for("remove_expired_sessions_cron"),
+                                payload={"cursor": next_cursor}, queue="default")
+
+        return message
@@ -1,12 +1,29 @@
-from flask import request
+import json
+import logging
+from flask import request, url_for
 
 from models.user import User
 from utils.environment import is_local
+from utils.task_helper import run_background_task
+
+
+# how long one run of this cron may delete users (in seconds); if there are more users left, the cron continues in a
+# background task
+TIME_BUDGET = 60
 
 
 def remove_unverified_users_cron():
     # only run this cron if it was called by the GAE Cron Service (header X-AppEngine-Cron) or if it's on
-    # localhost (tests)
-    if request.headers.get("X-AppEngine-Cron") or is_local():
-        User.remove_unverified_users()
-        return "Success"
+    # localhost (tests). It continues itself as a Cloud Tasks task (header X-AppEngine-QueueName), with the cursor
+    # in the request body.
+    if request.headers.get("X-AppEngine-Cron") or request.headers.get("X-AppEngine-QueueName") or is_local():
+        data = json.loads(request.get_data(as_text=True) or "{}")
+
+        deleted, next_cursor, more = User.remove_unverified_users(cursor=data.get("cursor"), time_budget=TIME_BUDGET)
+        logging.info("Removed {0} unverified users{1}.".format(deleted, " (continuing)" if more else ""))
+
+        if more and next_cursor:
+            run_background_task(relative_path=url_for("remove_unverified_users_cron"),
+                                payload={"cursor": next_cursor}, queue="default")
+
+        return "Removed {0} unverified users".format(deleted)
@@ -1,5 +1,8 @@
-from models.user import User
-from flask import render_template, request
+import csv
+import io
+import json
+from models.user import User, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from flask import render_template, request, Response, stream_with_context
 
 
 def users_list(**params):
@@ -8,9 +11,61 @@ def users_list(**params):
 
     if success:
         params["current_user"] = user
-        params["users"] = User.fetch()
+
+        page_size = min(max(request.args.get("page_size", DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+        users, prev_cursor, next_cursor = User.fetch_page(page_size=page_size, cursor=request.args.get("cursor"))
+
+        params["users"] = users
+        params["page_size"] = page_size
+        params["prev_cursor"] = prev_cursor
+        params["next_cursor"] = next_cursor
 
         return render_template("admin/users/users-list.html", **params)
     else:
         params["error_message"] = message
         return render_template("public/auth/error_page.html", **params)
+
+
+EXPORT_FIELDS = ["email", "verified", "sessions", "last_login", "cursor"]
+
+
+# streams all users as CSV (default) or NDJSON (?format=ndjson). The export can be resumed with ?cursor=<the cursor
+# of the last row received>.
+def users_export(**params):
+    token = request.cookies.get('my-simple-app-session')
+    success, user, message = User.verify_session(token)
+
+    if not success:
+        params["error_message"] = message
+        return render_template("public/auth/error_page.html", **params)
+
+    export_format = request.args.get("format", "csv")
+    rows = User.export(cursor=request.args.get("cursor"))
+
+    if export_format == "ndjson":
+        def generate():
+            for row in rows:
+                yield json.dumps(row) + "\n"
+
+        mimetype = "application/x-ndjson"
+    else:
+        def generate():
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+
+            for row in rows:
+                writer.writerow(row)
+
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+            yield buffer.getvalue()  # only the header, if there are no users
+
+        export_format = "csv"
+        mimetype = "text/csv"
+
+    # the rows are read from the Datastore while the response is being sent
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={"Content-Disposition": "attachment; filename=users.{0}".format(export_format)})
@@ -0,0 +1,13 @@
+from flask import render_template
+
+
+def service_unavailable(error, **params):
+    # e.g. when the password hashing queue is full (see utils/password_helper.py)
+    params["error_message"] = error.description
+    return render_template("public/auth/error_page.html", **params), 503, {"Retry-After": "5"}
+
+
+def too_many_requests(error, **params):
+    # e.g. too many login attempts from the same IP address or for the same e-mail (see utils/rate_limit.py)
+    params["error_message"] = error.description
+    return render_template("public/auth/error_page.html", **params), 429, {"Retry-After": str(error.retry_after or 60)}
@@ -0,0 +1,12 @@
+from flask import request, Response
+
+from utils import metrics
+from utils.environment import is_local
+
+
+def metrics_endpoint():
+    # protected like the crons: only the GAE Cron Service (header X-AppEngine-Cron) or localhost can read the metrics
+    if request.headers.get("X-AppEngine-Cron") or is_local():
+        return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+    return "Forbidden", 403
@@ -1,6 +1,6 @@
-import bcrypt
 from flask import request, make_response, redirect, url_for, render_template
 from models.user import User
+from utils.password_helper import check_password
 
 
 def logout(**params):
@@ -35,7 +35,7 @@ def change_password(**params):
         token = request.cookies.get('my-simple-app-session')
         success, user, message = User.verify_session(token)
 
-        csrf_token = User.generate_csrf_token(user)
+        csrf_token = User.generate_csrf_token(user, token)
 
         if success and csrf_token:
             params["current_user"] = user
@@ -53,13 +53,13 @@ def change_password(**params):
         current_password = request.form.get("current_password")
         new_password = request.form.get("new_password")
         form_csrf_token = request.form.get("csrf_token")
-        csrf_validation_success = User.validate_csrf_token(user, form_csrf_token)
+        csrf_validation_success = User.validate_csrf_token(user, token, form_csrf_token)
 
         if current_email and current_password and new_password and csrf_validation_success:
             # checks if user with this e-mail and password exists
             user = User.get_user_by_email(current_email)
 
-            if user and bcrypt.checkpw(current_password.encode("utf-8"), user.password.encode("utf-8")):
+            if user and check_password(current_password, user.password):
                 confirmation_code_sent = User.change_password_code(user, new_password)
 
                 if confirmation_code_sent:
@@ -95,6 +95,9 @@ def change_password_confirmation(code, **params):
                 response.set_cookie('my-simple-app-session', '', expires=0)
 
                 return response
+            else:
+                params["error_message"] = update_message
+                return render_template("public/auth/error_page.html", **params)
         else:
             params["error_message"] = message
             return render_template("public/auth/error_page.html", **params)
@@ -1,7 +1,8 @@
-import bcrypt
 import logging
 from flask import request, render_template, redirect, url_for
 from models.user import User
+from utils import rate_limit
+from utils.password_helper import check_password, hash_password
 
 
 def registration(**params):
@@ -64,6 +65,9 @@ def forgot_password(**params):
     elif request.method == "POST":
         email = request.form.get("email")
 
+        # before any Datastore reads or e-mails
+        rate_limit.check("forgot_password", ip=request.access_route[-1], email=email)
+
         if email:
             user = User.get_user_by_email(email)
 
@@ -96,22 +100,20 @@ def forgot_password_confirmation(code, **params):
                 return render_template("public/auth/error_page.html", **params)
 
     elif request.method == "POST":
-        current_email = request.form.get("user_email")
         new_password = request.form.get("new_password")
 
-        if current_email and new_password:
-            # checks if user with this e-mail and password exists
-            user = User.get_user_by_email(current_email)
+        if new_password:
+            # the user is identified by the confirmation code (not by the e-mail in the form, which can be changed)
+            success, user, message = User.forgot_password_code_confirmation(code)
 
-            if user:
-                if bcrypt.checkpw(new_password.encode("utf-8"), user.password.encode("utf-8")):
+            if success:
+                if check_password(new_password, user.password):
                     params["current_user"] = user
                     params["danger_message"] = "New password can not be the same as old one, please try again."
                     return render_template("public/auth/forgot_password_form.html", **params)
                 else:
                     # hash the new password
-                    hashed = bcrypt.hashpw(new_password.encode('utf8'), bcrypt.gensalt())
-                    new_password_hash = hashed.decode('utf8')
+                    new_password_hash = hash_password(new_password)
 
                     update_success, update_message = User.update_password(user, new_password_hash)
 
@@ -120,7 +122,7 @@ def forgot_password_confirmation(code, **params):
                         User.delete_all_user_sessions(user)
 
                         # send e-mail that password was changed
-                        User.forgot_password_success(user)
+                        User.forgot_password_success(user, code)
 
                         login_message = "Your password has been changed, please login again."
                         return redirect(url_for("public.main.login", info_message=login_message))
@@ -128,5 +130,5 @@ def forgot_password_confirmation(code, **params):
                         params["error_message"] = update_message
                         return render_template("public/auth/error_page.html", **params)
             else:
-                params["error_message"] = "No user found with this e-mail, please try again."
+                params["error_message"] = message
                 return render_template("public/auth/error_page.html", **params)
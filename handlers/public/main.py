@@ -1,7 +1,8 @@
 import datetime
-import bcrypt
 from flask import request, render_template, redirect, url_for, make_response
 from models.user import User
+from utils import rate_limit
+from utils.password_helper import check_password
 
 
 def login(**params):
@@ -20,17 +21,23 @@ def login(**params):
         email = request.form.get("email")
         password = request.form.get("password")
 
+        # before any password hashing or Datastore reads
+        rate_limit.check("login", ip=request.access_route[-1], email=email)
+
         if email and password:
             # checks if user with this email exists
             user = User.get_user_by_email(email)
 
             if user:
-                if user.verification_code != "":
+                if not user.is_verified:
                     message = "Please verify your e-mail, we've sent you instructions."
                     params["danger_message"] = message
                     return render_template("public/main/index.html", **params)
 
-                if bcrypt.checkpw(password.encode("utf-8"), user.password.encode("utf-8")):
+                if check_password(password, user.password):
+                    # the bcrypt cost may have changed since the password was hashed
+                    User.rehash_password_if_needed(user, password)
+
                     token = User.generate_session(user)
 
                     response = make_response(redirect(url_for("admin.users.users_list")))
@@ -0,0 +1,25 @@
+from models.settings import Settings
+from utils import password_policy
+from utils.email_renderer import get_renderer
+from utils.environment import is_local
+from utils.task_helper import get_tasks_client
+
+
+def warmup():
+    # GAE sends a warmup request to every new instance before it starts serving traffic (see inbound_services in
+    # app.yaml), so settings are already in memory when the first real request comes in
+    Settings.preload()
+
+    # pick the bcrypt cost (this only benchmarks the instance if BCRYPT_TARGET_MS is set, see utils/password_policy.py)
+    password_policy.get_rounds()
+
+    # compile the e-mail templates
+    get_renderer()
+
+    # modules and clients that are only loaded on first use, to keep the cold start short
+    import bleach  # noqa: F401 (used by User.normalize_email)
+
+    if not is_local():
+        get_tasks_client()  # Cloud Tasks is only used in production
+
+    return "", 200
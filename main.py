@@ -1,13 +1,33 @@
 from flask import Flask
+from cron.remove_expired_codes import remove_expired_codes_cron
+from cron.remove_expired_sessions import remove_expired_sessions_cron
 from cron.remove_unverified_users import remove_unverified_users_cron
+from handlers import errors, metrics, warmup
 from handlers.admin import users
 from handlers.public import main as public_main, auth
 from handlers.profile.auth import logout, change_password, change_password_confirmation
+from models import ndb_wsgi_middleware, unit_of_work
+from tasks.migrate_users_task import migrate_users
 from tasks.send_email_task import send_email_via_sendgrid
+from utils import instrumentation
 from utils.environment import is_local
 
 
 app = Flask(__name__)
+app.wsgi_app = ndb_wsgi_middleware(app.wsgi_app)  # one ndb context per request
+
+# request timings (Server-Timing header and /metrics); registered before the other after_request handlers, so it runs
+# after them (Flask runs them in reverse order)
+app.before_request(instrumentation.start_request)
+app.after_request(instrumentation.finish_request)
+instrumentation.install_datastore_hooks()
+instrumentation.connect_template_signals(app)
+
+app.after_request(unit_of_work.flush_after_request)  # changes are written once, at the end of the request
+
+# ERROR PAGES
+app.register_error_handler(503, errors.service_unavailable)
+app.register_error_handler(429, errors.too_many_requests)
 
 # PUBLIC URLS
 
@@ -27,6 +47,8 @@ app.add_url_rule(rule="/email-verification/<code>", endpoint="public.auth.email_
 
 # USERS LIST
 app.add_url_rule(rule="/admin/users", endpoint="admin.users.users_list", view_func=users.users_list, methods=["GET"])
+app.add_url_rule(rule="/admin/users/export", endpoint="admin.users.users_export", view_func=users.users_export,
+                 methods=["GET"])
 
 # LOG OUT
 app.add_url_rule(rule="/logout", endpoint="profile.auth.logout", view_func=logout, methods=["POST"])
@@ -48,14 +70,29 @@ app.add_url_rule(rule="/forgot-password-confirmation/<code>", endpoint="public.a
                  view_func=auth.forgot_password_confirmation, methods=["GET", "POST"])
 
 
+# WARMUP (GAE)
+app.add_url_rule(rule="/_ah/warmup", endpoint="warmup", view_func=warmup.warmup, methods=["GET"])
+
+# METRICS (Prometheus text format)
+app.add_url_rule(rule="/metrics", endpoint="metrics", view_func=metrics.metrics_endpoint, methods=["GET"])
+
+
 # CRON JOBS
-app.add_url_rule(rule="/cron/remove_unverified_users_cron", view_func=remove_unverified_users_cron, methods=["GET"])
+app.add_url_rule(rule="/cron/remove_unverified_users_cron", view_func=remove_unverified_users_cron,
+                 methods=["GET", "POST"])
+app.add_url_rule(rule="/cron/remove_expired_codes_cron", view_func=remove_expired_codes_cron, methods=["GET"])
+app.add_url_rule(rule="/cron/remove_expired_sessions_cron", view_func=remove_expired_sessions_cron,
+                 methods=["GET", "POST"])
 
 
 # TASKS
 app.add_url_rule(rule="/tasks/send-email", endpoint="tasks.send_email_task.send_email_via_sendgrid",
                  view_func=send_email_via_sendgrid, methods=["POST"])
 
+# DATA MIGRATIONS (see MIGRATIONS in tasks/migrate_users_task.py)
+app.add_url_rule(rule="/tasks/migrate-users/<migration>", endpoint="tasks.migrate_users_task.migrate_users",
+                 view_func=migrate_users, methods=["POST"])
+
 
 # FOR RUNNING THE APP
 
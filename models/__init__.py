@@ -1,28 +1,83 @@
 import os
+import contextlib
+import threading
 from google.cloud import ndb
-import google.auth.credentials
-import mock
 
 
+# "emulator" (default) uses the Datastore emulator locally, "memory" keeps all data in the memory of the process
+# (see models/memory_datastore.py), so the app, TESTING mode and benchmarks run without the emulator
+DATASTORE_BACKEND = os.environ.get("DATASTORE_BACKEND", "emulator")
+
+_client = None
+_client_lock = threading.Lock()
+
+
+# returns the ndb client shared by the whole instance. It's created on first use, not on import: creating a client
+# opens a gRPC channel (and looks up credentials in production), which would slow down every cold start.
 def get_db():
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            _client = _create_client()
+
+    return _client
+
+
+def _create_client():
     if os.getenv('GAE_ENV', '').startswith('standard'):
         # production
-        db = ndb.Client()
-    else:
-        # localhost
-        os.environ["DATASTORE_DATASET"] = "test"
-        os.environ["DATASTORE_PROJECT_ID"] = "test"
-
-        if os.getenv('TESTING', '').startswith('yes'):
-            os.environ["DATASTORE_EMULATOR_HOST"] = "localhost:8002"
-            os.environ["DATASTORE_EMULATOR_HOST_PATH"] = "localhost:8002/datastore"
-            os.environ["DATASTORE_HOST"] = "http://localhost:8002"
-        else:
-            os.environ["DATASTORE_EMULATOR_HOST"] = "localhost:8001"
-            os.environ["DATASTORE_EMULATOR_HOST_PATH"] = "localhost:8001/datastore"
-            os.environ["DATASTORE_HOST"] = "http://localhost:8001"
-
-        credentials = mock.Mock(spec=google.auth.credentials.Credentials)
+        return ndb.Client()
+
+    # localhost (the fake credentials are only needed here, so mock isn't imported in production)
+    import google.auth.credentials
+    import mock
+
+    credentials = mock.Mock(spec=google.auth.credentials.Credentials)
+
+    if DATASTORE_BACKEND == "memory":
+        from models.memory_datastore import get_stub
+
         db = ndb.Client(project="test", credentials=credentials)
+        db.stub = get_stub()  # ndb sends all Datastore requests to the client's stub
+        return db
+
+    os.environ["DATASTORE_DATASET"] = "test"
+    os.environ["DATASTORE_PROJECT_ID"] = "test"
+
+    if os.getenv('TESTING', '').startswith('yes'):
+        os.environ["DATASTORE_EMULATOR_HOST"] = "localhost:8002"
+        os.environ["DATASTORE_EMULATOR_HOST_PATH"] = "localhost:8002/datastore"
+        os.environ["DATASTORE_HOST"] = "http://localhost:8002"
+    else:
+        os.environ["DATASTORE_EMULATOR_HOST"] = "localhost:8001"
+        os.environ["DATASTORE_EMULATOR_HOST_PATH"] = "localhost:8001/datastore"
+        os.environ["DATASTORE_HOST"] = "http://localhost:8001"
+
+    return ndb.Client(project="test", credentials=credentials)
+
+
+# reuses the ndb context of the current request (see ndb_wsgi_middleware) or opens a new one if there is none
+# (e.g. in a background thread)
+@contextlib.contextmanager
+def db_context(client=None):
+    context = ndb.get_context(raise_context_error=False)
+
+    if context is not None:
+        yield context
+    else:
+        from models.global_cache import get_global_cache, global_cache_policy
+
+        with (client or get_db()).context(global_cache=get_global_cache(),
+                                          global_cache_policy=global_cache_policy) as context:
+            yield context
+
+
+# WSGI middleware that opens one ndb context (with the global cache) for the whole request, so all model methods
+# called during the request share the same context cache
+def ndb_wsgi_middleware(wsgi_app):
+    def middleware(environ, start_response):
+        with db_context():
+            return wsgi_app(environ, start_response)
 
-    return db
+    return middleware
@@ -0,0 +1,104 @@
+import threading
+from google.cloud import ndb
+from utils.cache import LRUCache
+
+
+# kinds that are never stored in the in-memory global cache: other instances can't invalidate it, so they would keep
+# using e.g. an old password hash, a deleted session or a used one-time code until the entry expires
+LOCAL_CACHE_EXCLUDED_KINDS = ("User", "Session", "OneTimeCode")
+
+
+class InMemoryGlobalCache(ndb.GlobalCache):
+    """ndb global cache that keeps serialized entities in memory of the current instance.
+
+    The values are stored in a backend object with the same interface as utils.cache.LRUCache (get, set, delete
+    and clear), so a different store can be plugged in. Other instances don't see writes made on this one, which is
+    why entries expire after the backend's TTL and why kinds in LOCAL_CACHE_EXCLUDED_KINDS are not cached at all
+    (see global_cache_policy).
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or LRUCache(max_size=10000, ttl=60)
+
+        self._lock = threading.Lock()
+        self._watched = threading.local()  # values watched by compare_and_swap (per thread, like ndb contexts)
+
+    @property
+    def _watch_keys(self):
+        if not hasattr(self._watched, "keys"):
+            self._watched.keys = {}
+
+        return self._watched.keys
+
+    def get(self, keys):
+        return [self.backend.get(key) for key in keys]
+
+    def set(self, items, expires=None):
+        with self._lock:
+            for key, value in items.items():
+                self.backend.set(key, value, ttl=expires)
+
+    def set_if_not_exists(self, items, expires=None):
+        results = {}
+
+        with self._lock:
+            for key, value in items.items():
+                results[key] = self.backend.get(key) is None
+
+                if results[key]:
+                    self.backend.set(key, value, ttl=expires)
+
+        return results
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self.backend.delete(key)
+
+    def watch(self, items):
+        self._watch_keys.update(items)
+
+    def unwatch(self, keys):
+        for key in keys:
+            self._watch_keys.pop(key, None)
+
+    def compare_and_swap(self, items, expires=None):
+        results = {}
+
+        with self._lock:
+            for key, value in items.items():
+                # only set the value if nobody changed it since it was watched
+                results[key] = key in self._watch_keys and self._watch_keys.pop(key) == self.backend.get(key)
+
+                if results[key]:
+                    self.backend.set(key, value, ttl=expires)
+
+        return results
+
+    def clear(self):
+        self.backend.clear()
+
+
+_global_cache = None
+
+
+# returns the global cache shared by all ndb contexts of this instance: Redis (if REDIS_CACHE_URL environment
+# variable is set), memcache (if MEMCACHED_HOSTS is set) or the in-memory cache
+def get_global_cache():
+    global _global_cache
+
+    if _global_cache is None:
+        _global_cache = ndb.RedisCache.from_environment() or ndb.MemcacheCache.from_environment() or \
+                        InMemoryGlobalCache()
+
+    return _global_cache
+
+
+# ndb global cache policy: with the in-memory cache (not shared by instances), entities of LOCAL_CACHE_EXCLUDED_KINDS
+# are always read from the Datastore
+def global_cache_policy(key):
+    if isinstance(get_global_cache(), InMemoryGlobalCache):
+        kind = key.kind() if callable(key.kind) else key.kind  # ndb passes ndb keys as well as Datastore keys
+        return kind not in LOCAL_CACHE_EXCLUDED_KINDS
+
+    return True
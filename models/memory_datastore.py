@@ -0,0 +1,470 @@
+import base64
+import functools
+import itertools
+import json
+import threading
+
+from google.api_core import exceptions as core_exceptions
+from google.cloud.datastore_v1.types import datastore as datastore_pb2
+from google.cloud.datastore_v1.types import entity as entity_pb2
+from google.cloud.datastore_v1.types import query as query_pb2
+
+
+# An in-process stand-in for the Datastore API, used instead of the Datastore emulator when DATASTORE_BACKEND is
+# "memory" (see models.get_db). ndb sends every request through the "stub" of its client, so the models don't know
+# the difference: this stub answers lookups, queries (equality and inequality filters, ancestors, orders,
+# projections, keys only, cursors, offsets and limits), commits, transactions and id allocations from dictionaries
+# in memory. Everything is strongly consistent. Unindexed properties can't be filtered or sorted on, like in the real
+# Datastore. Data is lost when the process exits.
+
+_Operator = query_pb2.PropertyFilter.Operator
+_CompositeOperator = query_pb2.CompositeFilter.Operator
+_Direction = query_pb2.PropertyOrder.Direction
+_ResultType = query_pb2.EntityResult.ResultType
+_MoreResults = query_pb2.QueryResultBatch.MoreResultsType
+
+# the order of value types in the Datastore
+_TYPE_RANKS = {
+    "null_value": 0,
+    "integer_value": 1,
+    "timestamp_value": 2,
+    "boolean_value": 3,
+    "blob_value": 4,
+    "string_value": 5,
+    "double_value": 6,
+    "geo_point_value": 7,
+    "key_value": 8,
+}
+
+
+class _DoneFuture(object):
+    """A gRPC-like future that is already done (ndb only uses these methods)."""
+
+    def __init__(self, result=None, exception=None):
+        self._result = result
+        self._exception = exception
+
+    def result(self, timeout=None):
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        return self._exception
+
+    def add_done_callback(self, callback):
+        callback(self)
+
+    def done(self):
+        return True
+
+    def cancel(self):
+        return False
+
+    def cancelled(self):
+        return False
+
+
+class _Method(object):
+    """A gRPC-like method: ndb calls method.future(request, timeout=..., metadata=...)."""
+
+    def __init__(self, function, response_class):
+        self.function = function
+        self.response_class = response_class
+
+    def future(self, request, timeout=None, metadata=()):
+        try:
+            response = self.function(type(request).pb(request))
+            return _DoneFuture(result=self.response_class.wrap(response))
+        except Exception as e:
+            return _DoneFuture(exception=e)
+
+    def __call__(self, request, timeout=None, metadata=()):
+        return self.future(request, timeout=timeout, metadata=metadata).result()
+
+
+def _key_path(key_pb):
+    return tuple((element.kind, 0, element.id) if element.WhichOneof("id_type") == "id" else
+                 (element.kind, 1, element.name) for element in key_pb.path)
+
+
+def _storage_key(key_pb):
+    return key_pb.partition_id.namespace_id, _key_path(key_pb)
+
+
+def _comparable(value_pb):
+    value_type = value_pb.WhichOneof("value_type")
+
+    if value_type in (None, "null_value"):
+        return 0, None
+    if value_type == "timestamp_value":
+        return 2, (value_pb.timestamp_value.seconds, value_pb.timestamp_value.nanos)
+    if value_type == "key_value":
+        return 8, _key_path(value_pb.key_value)
+    if value_type == "geo_point_value":
+        return 7, (value_pb.geo_point_value.latitude, value_pb.geo_point_value.longitude)
+
+    return _TYPE_RANKS.get(value_type, 9), getattr(value_pb, value_type)
+
+
+# JSON can't tell tuples from lists, so positions read from cursors are converted back
+def _tuples(value):
+    return tuple(_tuples(item) for item in value) if isinstance(value, list) else value
+
+
+def _encode_cursor(position):
+    def default(value):
+        if isinstance(value, bytes):
+            return base64.b64encode(value).decode()
+        raise TypeError(value)
+
+    return json.dumps(position, default=default).encode()
+
+
+def _decode_cursor(cursor):
+    return _tuples(json.loads(cursor.decode()))
+
+
+class InMemoryDatastoreStub(object):
+    """The Datastore API (the methods ndb calls on its client's stub), kept in memory."""
+
+    def __init__(self):
+        self._entities = {}  # kind: {(namespace, key path): (entity pb, version)}
+        self._transactions = {}  # transaction id: {(kind, storage key): version read in the transaction}
+        self._lock = threading.RLock()
+        self._versions = itertools.count(1)
+        self._ids = itertools.count(1)
+
+        self.lookup = _Method(self._lookup, datastore_pb2.LookupResponse)
+        self.run_query = _Method(self._run_query, datastore_pb2.RunQueryResponse)
+        self.begin_transaction = _Method(self._begin_transaction, datastore_pb2.BeginTransactionResponse)
+        self.commit = _Method(self._commit, datastore_pb2.CommitResponse)
+        self.rollback = _Method(self._rollback, datastore_pb2.RollbackResponse)
+        self.allocate_ids = _Method(self._allocate_ids, datastore_pb2.AllocateIdsResponse)
+        self.reserve_ids = _Method(lambda request: datastore_pb2.ReserveIdsResponse.pb()(),
+                                   datastore_pb2.ReserveIdsResponse)
+
+    # removes all entities
+    def clear(self):
+        with self._lock:
+            self._entities.clear()
+            self._transactions.clear()
+
+    def _get(self, key_pb):
+        kind = key_pb.path[-1].kind
+        return self._entities.get(kind, {}).get(_storage_key(key_pb))
+
+    # LOOKUP
+
+    def _lookup(self, request):
+        response = datastore_pb2.LookupResponse.pb()()
+        transaction = request.read_options.transaction or None
+
+        with self._lock:
+            for key_pb in request.keys:
+                if key_pb.partition_id.project_id != request.project_id:
+                    raise core_exceptions.InvalidArgument("The key belongs to a different project.")
+
+                stored = self._get(key_pb)
+
+                if transaction is not None and transaction in self._transactions:
+                    self._transactions[transaction][(key_pb.path[-1].kind, _storage_key(key_pb))] = \
+                        stored[1] if stored else 0
+
+                if stored:
+                    result = response.found.add()
+                    result.entity.CopyFrom(stored[0])
+                    result.version = stored[1]
+                else:
+                    result = response.missing.add()
+                    result.entity.key.CopyFrom(key_pb)
+
+        return response
+
+    # TRANSACTIONS AND COMMITS
+
+    def _begin_transaction(self, request):
+        with self._lock:
+            transaction = "transaction-{0}".format(next(self._ids)).encode()
+            self._transactions[transaction] = {}
+
+        response = datastore_pb2.BeginTransactionResponse.pb()()
+        response.transaction = transaction
+        return response
+
+    def _rollback(self, request):
+        with self._lock:
+            self._transactions.pop(request.transaction, None)
+
+        return datastore_pb2.RollbackResponse.pb()()
+
+    def _allocate_ids(self, request):
+        response = datastore_pb2.AllocateIdsResponse.pb()()
+
+        with self._lock:
+            for key_pb in request.keys:
+                key = response.keys.add()
+                key.CopyFrom(key_pb)
+                key.path[-1].id = next(self._ids)
+
+        return response
+
+    def _commit(self, request):
+        response = datastore_pb2.CommitResponse.pb()()
+
+        with self._lock:
+            if request.transaction:
+                read_versions = self._transactions.pop(request.transaction, None)
+
+                if read_versions is None:
+                    raise core_exceptions.InvalidArgument("Unknown transaction.")
+
+                # optimistic concurrency: entities read in the transaction must not have changed since
+                for (kind, storage_key), version in read_versions.items():
+                    stored = self._entities.get(kind, {}).get(storage_key)
+
+                    if (stored[1] if stored else 0) != version:
+                        raise core_exceptions.Aborted("Too much contention on these datastore entities.")
+
+            # check all mutations first, so a failing commit doesn't change anything
+            mutated = set()
+            for mutation in request.mutations:
+                operation = mutation.WhichOneof("operation")
+                key_pb = mutation.delete if operation == "delete" else getattr(mutation, operation).key
+
+                if not request.transaction and (key_pb.path[-1].id or key_pb.path[-1].name):
+                    if _storage_key(key_pb) in mutated:
+                        raise core_exceptions.InvalidArgument("A non-transactional commit may not contain multiple "
+                                                              "mutations affecting the same entity.")
+                    mutated.add(_storage_key(key_pb))
+
+                if operation == "insert" and self._get(mutation.insert.key):
+                    raise core_exceptions.AlreadyExists("Entity already exists.")
+                if operation == "update" and not self._get(mutation.update.key):
+                    raise core_exceptions.NotFound("No entity to update.")
+
+            for mutation in request.mutations:
+                operation = mutation.WhichOneof("operation")
+                result = response.mutation_results.add()
+                version = next(self._versions)
+
+                if operation == "delete":
+                    self._entities.get(mutation.delete.path[-1].kind, {}).pop(_storage_key(mutation.delete), None)
+                else:
+                    entity = entity_pb2.Entity.pb()()
+                    entity.CopyFrom(getattr(mutation, operation))
+
+                    last = entity.key.path[-1]
+                    if not last.id and not last.name:
+                        last.id = next(self._ids)  # incomplete key
+                        result.key.CopyFrom(entity.key)
+
+                    self._entities.setdefault(last.kind, {})[_storage_key(entity.key)] = (entity, version)
+
+                result.version = version
+
+        return response
+
+    # QUERIES
+
+    # the indexed values of a property (values of repeated properties are all included)
+    @staticmethod
+    def _values(entity, name):
+        if name == "__key__":
+            return [(8, _key_path(entity.key))]
+
+        properties = entity.properties
+        value_pb = properties.get(name) if name in properties else None
+
+        if value_pb is None and "." in name:
+            # structured properties stored as embedded entities
+            parent_name, _, child_name = name.partition(".")
+            parent = properties.get(parent_name) if parent_name in properties else None
+
+            if parent is None:
+                return []
+
+            parents = parent.array_value.values if parent.WhichOneof("value_type") == "array_value" else [parent]
+            return [value for item in parents if item.WhichOneof("value_type") == "entity_value"
+                    for value in InMemoryDatastoreStub._values(item.entity_value, child_name)]
+
+        if value_pb is None:
+            return []
+
+        if value_pb.WhichOneof("value_type") == "array_value":
+            return [_comparable(item) for item in value_pb.array_value.values if not item.exclude_from_indexes]
+
+        if value_pb.exclude_from_indexes:
+            return []
+
+        return [_comparable(value_pb)]
+
+    def _matches(self, entity, filter_pb):
+        filter_type = filter_pb.WhichOneof("filter_type")
+
+        if filter_type == "composite_filter":
+            results = (self._matches(entity, item) for item in filter_pb.composite_filter.filters)
+            return any(results) if filter_pb.composite_filter.op == _CompositeOperator.OR else all(results)
+
+        if filter_type != "property_filter":
+            return True
+
+        property_filter = filter_pb.property_filter
+        op = property_filter.op
+        name = property_filter.property.name
+
+        if op == _Operator.HAS_ANCESTOR:
+            ancestor = _key_path(property_filter.value.key_value)
+            return _key_path(entity.key)[:len(ancestor)] == ancestor
+
+        values = self._values(entity, name)
+
+        if op in (_Operator.IN, _Operator.NOT_IN):
+            targets = [_comparable(item) for item in property_filter.value.array_value.values]
+
+            if op == _Operator.IN:
+                return any(value in targets for value in values)
+            return bool(values) and all(value not in targets for value in values)
+
+        target = _comparable(property_filter.value)
+        compare = {
+            _Operator.EQUAL: lambda value: value == target,
+            _Operator.NOT_EQUAL: lambda value: value != target,
+            _Operator.LESS_THAN: lambda value: value < target,
+            _Operator.LESS_THAN_OR_EQUAL: lambda value: value <= target,
+            _Operator.GREATER_THAN: lambda value: value > target,
+            _Operator.GREATER_THAN_OR_EQUAL: lambda value: value >= target,
+        }[op]
+
+        # a repeated property matches if any of its values matches (values of other types never match inequalities)
+        return any(compare(value) for value in values
+                   if op in (_Operator.EQUAL, _Operator.NOT_EQUAL) or value[0] == target[0])
+
+    # the position of the entity in the query results: the values of the sorted properties and the key
+    def _position(self, entity, orders):
+        position = []
+
+        for order in orders:
+            values = self._values(entity, order.property.name)
+            if not values:
+                return None  # entities without the (indexed) property are not in the results
+
+            position.append(max(values) if order.direction == _Direction.DESCENDING else min(values))
+
+        position.append((8, _key_path(entity.key)))
+
+        return tuple(position)
+
+    @staticmethod
+    def _compare_function(orders):
+        directions = [-1 if order.direction == _Direction.DESCENDING else 1 for order in orders] + [1]
+
+        def compare(first, second):
+            for direction, first_value, second_value in zip(directions, first, second):
+                if first_value != second_value:
+                    return direction if first_value > second_value else -direction
+            return 0
+
+        return compare
+
+    def _run_query(self, request):
+        query = request.query
+        namespace = request.partition_id.namespace_id
+        orders = [order for order in query.order if order.property.name != "__key__"]
+        projection = [item.property.name for item in query.projection]
+        keys_only = projection == ["__key__"]
+
+        compare = self._compare_function(orders)
+        start = _decode_cursor(query.start_cursor) if query.start_cursor else None
+        end = _decode_cursor(query.end_cursor) if query.end_cursor else None
+
+        with self._lock:
+            kinds = [kind.name for kind in query.kind] or list(self._entities)
+            results = []
+
+            for kind in kinds:
+                for (entity_namespace, _), (entity, version) in self._entities.get(kind, {}).items():
+                    if entity_namespace != namespace:
+                        continue
+                    if query.HasField("filter") and not self._matches(entity, query.filter):
+                        continue
+
+                    position = self._position(entity, orders)
+                    if position is None:
+                        continue
+                    if start is not None and compare(position, start) <= 0:
+                        continue
+                    if end is not None and compare(position, end) > 0:
+                        continue
+
+                    results.append((position, entity, version))
+
+        results.sort(key=functools.cmp_to_key(lambda first, second: compare(first[0], second[0])))
+
+        if projection and not keys_only and query.distinct_on:
+            seen = set()
+            distinct = []
+            for result in results:
+                values = tuple(tuple(self._values(result[1], item.name)) for item in query.distinct_on)
+                if values not in seen:
+                    seen.add(values)
+                    distinct.append(result)
+            results = distinct
+
+        skipped = min(query.offset, len(results))
+        results = results[skipped:]
+
+        limit = query.limit.value if query.HasField("limit") else None
+        more = limit is not None and len(results) > limit
+        if limit is not None:
+            results = results[:limit]
+
+        response = datastore_pb2.RunQueryResponse.pb()()
+        batch = response.batch
+        batch.skipped_results = skipped
+        batch.more_results = _MoreResults.MORE_RESULTS_AFTER_LIMIT if more else _MoreResults.NO_MORE_RESULTS
+
+        if keys_only:
+            batch.entity_result_type = _ResultType.KEY_ONLY
+        elif projection:
+            batch.entity_result_type = _ResultType.PROJECTION
+        else:
+            batch.entity_result_type = _ResultType.FULL
+
+        for position, entity, version in results:
+            result = batch.entity_results.add()
+            result.cursor = _encode_cursor(position)
+            result.version = version
+            result.entity.key.CopyFrom(entity.key)
+
+            if keys_only:
+                continue
+
+            if projection:
+                for name in projection:
+                    value = entity.properties.get(name) if name in entity.properties else None
+                    if value is not None:
+                        if value.WhichOneof("value_type") == "array_value" and value.array_value.values:
+                            value = value.array_value.values[0]
+                        result.entity.properties[name].CopyFrom(value)
+            else:
+                result.entity.CopyFrom(entity)
+
+        batch.end_cursor = batch.entity_results[-1].cursor if results else query.start_cursor
+
+        return response
+
+
+_stub = None
+_stub_lock = threading.Lock()
+
+
+# returns the in-memory Datastore shared by the whole process (every ndb client uses the same data)
+def get_stub():
+    global _stub
+
+    with _stub_lock:
+        if _stub is None:
+            _stub = InMemoryDatastoreStub()
+
+    return _stub
@@ -0,0 +1,88 @@
+import datetime
+import hashlib
+import secrets
+from google.cloud import ndb
+from models import db_context, unit_of_work
+
+
+# indexed (see the index policy in models/user.py): purpose and expired (expired codes crons), user_key (email-keys
+# migration)
+class OneTimeCode(ndb.Model):
+    """A code sent to the user by e-mail (e.g. to verify the e-mail address), keyed by the hash of the code."""
+
+    # purposes
+    VERIFICATION = "verification"
+    PASSWORD_CHANGE = "password_change"
+    PASSWORD_FORGOT = "password_forgot"
+
+    # only the newest code of these purposes works: older ones are deleted when a new one is created and all of them
+    # are deleted when the password changes
+    PASSWORD_PURPOSES = (PASSWORD_CHANGE, PASSWORD_FORGOT)
+
+    purpose = ndb.StringProperty()
+    user_key = ndb.KeyProperty()
+    expired = ndb.DateTimeProperty()
+
+    @staticmethod
+    def hash_code(code):
+        return hashlib.sha256(str.encode(code)).hexdigest()
+
+    # generates a new code and stores its hash (the code itself is returned, so it can be sent to the user). The code
+    # is written at the end of the request, together with the other changes (see models/unit_of_work.py).
+    @classmethod
+    def create(cls, user, purpose, hours=24):
+        with db_context():
+            if purpose in cls.PASSWORD_PURPOSES:
+                unit_of_work.delete(cls.get_user_codes_keys(user.key, [purpose]))
+
+            code = secrets.token_hex()
+
+            one_time_code = cls(id=cls.hash_code(code), purpose=purpose, user_key=user.key,
+                                expired=datetime.datetime.now() + datetime.timedelta(hours=hours))
+            unit_of_work.save(one_time_code)
+
+            return code
+
+    # retrieves the code object if the code exists, has the right purpose and hasn't expired yet
+    @classmethod
+    def get_valid(cls, code, purpose):
+        if not code:
+            return None
+
+        with db_context():
+            one_time_code = cls.get_by_id(cls.hash_code(code))
+
+            if one_time_code and one_time_code.purpose == purpose and \
+                    one_time_code.expired > datetime.datetime.now():
+                return one_time_code
+
+            return None
+
+    # deletes a code (once it's used), at the end of the request
+    @classmethod
+    def delete_code(cls, code):
+        with db_context():
+            unit_of_work.delete([ndb.Key(cls, cls.hash_code(code))])
+
+        return True
+
+    # returns the keys of all codes of the user with one of the purposes
+    @classmethod
+    def get_user_codes_keys(cls, user_key, purposes):
+        with db_context():
+            return [one_time_code.key for one_time_code in cls.query(cls.user_key == user_key).fetch()
+                    if one_time_code.purpose in purposes]
+
+    # FOR CRON JOBS:
+    # deletes expired codes (expired verification codes are deleted together with their unverified users)
+    @classmethod
+    def delete_expired(cls):
+        with db_context():
+            keys = []
+            for purpose in (cls.PASSWORD_CHANGE, cls.PASSWORD_FORGOT):
+                keys += cls.query(cls.purpose == purpose,
+                                  cls.expired < datetime.datetime.now()).fetch(keys_only=True)
+
+            ndb.delete_multi(keys=keys)
+
+            return len(keys)
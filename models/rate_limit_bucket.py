@@ -0,0 +1,36 @@
+import time
+from google.cloud import ndb
+from models import db_context
+
+
+class RateLimitBucket(ndb.Model):
+    """A token bucket of the Datastore rate limit store (see utils/rate_limit.py), keyed by "<limit>:<value>"."""
+
+    tokens = ndb.FloatProperty(indexed=False)
+    updated = ndb.FloatProperty(indexed=False)  # unix time of the last refill
+
+    # takes one token from the bucket, returns (allowed, seconds until the next token)
+    @classmethod
+    def take(cls, key, capacity, refill_rate):
+        @ndb.transactional(retries=1)
+        def take_token():
+            now = time.time()
+            bucket = cls.get_by_id(key, use_cache=False, use_global_cache=False)
+
+            if bucket:
+                tokens = min(capacity, bucket.tokens + (now - bucket.updated) * refill_rate)
+            else:
+                bucket = cls(id=key)
+                tokens = capacity
+
+            if tokens < 1:
+                return False, (1 - tokens) / refill_rate  # rejected requests don't write anything
+
+            bucket.tokens = tokens - 1
+            bucket.updated = now
+            bucket.put(use_cache=False, use_global_cache=False)
+
+            return True, 0
+
+        with db_context():
+            return take_token()
@@ -1,18 +1,78 @@
+import logging
+import threading
+import time
 from google.cloud import ndb
-from models import get_db
+from models import db_context
 
 
-client = get_db()
+# settings are read on almost every request (e.g. is_local()), so all of them are loaded into memory at once and
+# refreshed in the background when they are older than SETTINGS_TTL seconds
+SETTINGS_TTL = 300
 
+_cache = {"settings": None, "loaded_at": 0.0, "refreshing": False}
+_cache_lock = threading.Lock()
 
+
+# indexed (see the index policy in models/user.py): name, so settings can be filtered in the Datastore console
 class Settings(ndb.Model):
     name = ndb.StringProperty()
-    value = ndb.StringProperty()
+    value = ndb.TextProperty()
+
+    # loads all settings from Datastore into the cache
+    @classmethod
+    def preload(cls):
+        with db_context():
+            settings = {}
+            for setting in cls.query().fetch():
+                settings.setdefault(setting.name, setting)
+
+        with _cache_lock:
+            _cache["settings"] = settings
+            _cache["loaded_at"] = time.monotonic()
+
+        return settings
+
+    # refreshes the cache in a background thread (if it's not being refreshed already)
+    @classmethod
+    def _refresh_in_background(cls):
+        with _cache_lock:
+            if _cache["refreshing"]:
+                return
+
+            _cache["refreshing"] = True
+
+        def refresh():
+            try:
+                cls.preload()
+            except Exception as e:
+                logging.error("Could not refresh settings (stale values are used until the next refresh): " + str(e))
+            finally:
+                with _cache_lock:
+                    _cache["refreshing"] = False
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    # returns all cached settings
+    @classmethod
+    def _get_cached(cls):
+        settings = _cache["settings"]
+
+        if settings is None:  # the first read loads the settings
+            return cls.preload()
+
+        if time.monotonic() - _cache["loaded_at"] > SETTINGS_TTL:
+            cls._refresh_in_background()  # meanwhile, the current (stale) values are returned
+
+        return settings
 
     # retrieves a setting by name
     @classmethod
     def get_by_name(cls, name):
-        with client.context():
-            setting = cls.query(cls.name == name).get()
+        return cls._get_cached().get(name)
+
+    # retrieves more settings at once (returns a dict with the setting name as key and None for missing settings)
+    @classmethod
+    def get_many(cls, names):
+        settings = cls._get_cached()
 
-            return setting
+        return {name: settings.get(name) for name in names}
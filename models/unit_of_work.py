@@ -0,0 +1,79 @@
+from flask import g, has_request_context
+from google.cloud import ndb
+
+
+# Entities changed during a request are collected here and written all at once when the request ends (see flush and
+# main.py), so a request that changes the same User entity several times (e.g. new password and deleted sessions)
+# writes it only once. Outside of requests (background threads) entities are written right away.
+
+
+def _pending():
+    if not has_request_context():
+        return None
+
+    if "unit_of_work" not in g:
+        g.unit_of_work = {"put": [], "delete": [], "callbacks": []}
+
+    return g.unit_of_work
+
+
+# schedules the entity to be written at the end of the request
+def save(entity):
+    pending = _pending()
+
+    if pending is None:
+        entity.put()
+    elif not any(item is entity for item in pending["put"]):
+        pending["put"].append(entity)
+
+
+# schedules the keys to be deleted at the end of the request (a key scheduled twice is deleted once, the Datastore
+# rejects a commit with two mutations of the same entity)
+def delete(keys):
+    pending = _pending()
+
+    if pending is None:
+        ndb.delete_multi(keys)
+    else:
+        for key in keys:
+            if key not in pending["delete"]:
+                pending["delete"].append(key)
+
+
+# calls the callback after the scheduled changes are written (e.g. to invalidate caches only when the Datastore
+# already has the new data)
+def on_flush(callback):
+    pending = _pending()
+
+    if pending is None:
+        callback()
+    else:
+        pending["callbacks"].append(callback)
+
+
+# writes all scheduled changes (puts and deletes are sent at the same time)
+def flush():
+    pending = g.pop("unit_of_work", None) if has_request_context() else None
+
+    if not pending:
+        return
+
+    futures = []
+    if pending["put"]:
+        futures.extend(ndb.put_multi_async(pending["put"]))
+    if pending["delete"]:
+        futures.extend(ndb.delete_multi_async(pending["delete"]))
+
+    for future in futures:
+        future.result()
+
+    for callback in pending["callbacks"]:
+        callback()
+
+
+# after_request handler: changes are written before the response is sent. Flask runs after_request handlers for
+# error responses too (e.g. abort(429) or abort(503), and unhandled errors when they aren't propagated), so the
+# changes scheduled before the error are written as well.
+def flush_after_request(response):
+    flush()
+    return response
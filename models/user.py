@@ -1,80 +1,143 @@
-import bleach
+import os
+import base64
+import logging
 import secrets
 import datetime
 import hashlib
-import bcrypt
-from operator import attrgetter
+import time
 from google.cloud import ndb
-from models import get_db
-from flask import request
+from models import db_context, unit_of_work
+from models.one_time_code import OneTimeCode
+from flask import g, request, has_request_context, after_this_request
+from utils.cache import LRUCache
 from utils.email_helper import send_email
+from utils import password_policy, signing
+from utils.password_helper import hash_password
 
 
-client = get_db()
+# "embedded" stores sessions in the User entity (sessions property), "entity" stores every session as its own entity
+# (with the user as its parent and the session token hash as its ID)
+SESSION_STORAGE = os.environ.get("SESSION_STORAGE", "embedded")
 
+# session token hash -> (user key, session expiration), so that verify_session can skip the Datastore query for
+# tokens it has already seen. Entries live for at most a minute, so sessions deleted on another instance stop
+# working here soon too.
+session_cache = LRUCache(max_size=10000, ttl=60)
 
-class Session(ndb.Model):
-    token_hash = ndb.StringProperty()
-    ip = ndb.StringProperty()
-    platform = ndb.StringProperty()
-    browser = ndb.StringProperty()
-    country = ndb.StringProperty()
-    user_agent = ndb.StringProperty()
-    expired = ndb.DateTimeProperty()
+# "true" also looks up users that the email-keys migration hasn't rekeyed yet (with a query on every e-mail that isn't
+# found by key), set it to "false" once the migration has run
+LEGACY_EMAIL_LOOKUP = os.environ.get("LEGACY_EMAIL_LOOKUP", "true").lower() == "true"
+
+# page size of the admin users list (see User.fetch_page)
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# how long a session is valid
+SESSION_DAYS = 30
+
+# "true" adds a short-lived signed claim (user key, session, expiration) to the session cookie
+# ("<session token>:<claim>"), so verify_session doesn't need to look up the session until the claim expires.
+# Sessions deleted on the server (logout elsewhere, password change) stay valid for at most SESSION_CLAIM_SECONDS.
+SESSION_CLAIMS = os.environ.get("SESSION_CLAIMS", "false").lower() == "true"
+SESSION_CLAIM_SECONDS = int(os.environ.get("SESSION_CLAIM_SECONDS", 300))
+SESSION_COOKIE = "my-simple-app-session"
+
+# how long a CSRF token is valid
+CSRF_TOKEN_HOURS = 3
 
+# CSRF tokens that have already been used on this instance (set CSRF_REPLAY_CACHE to "false" in app.yaml to turn it off)
+csrf_replay_cache = None
+if os.environ.get("CSRF_REPLAY_CACHE", "true").lower() != "false":
+    csrf_replay_cache = LRUCache(max_size=10000, ttl=CSRF_TOKEN_HOURS * 3600)
 
-class CSRFToken(ndb.Model):
-    token = ndb.StringProperty()
+
+# INDEX POLICY: only properties that are used in query filters or sort orders are indexed (listed above every model,
+# composite indexes are in index.yaml). Everything else is unindexed (TextProperty or indexed=False), so writes don't
+# update index rows nobody reads. Entities written before a property was unindexed keep its index rows until they are
+# re-saved by the index-policy migration.
+
+
+# indexed: token_hash (verify_session), expired (remove_expired_sessions)
+class Session(ndb.Model):
+    token_hash = ndb.StringProperty()
+    ip = ndb.TextProperty()
+    platform = ndb.TextProperty()
+    browser = ndb.TextProperty()
+    country = ndb.TextProperty()
+    user_agent = ndb.TextProperty()
+    created = ndb.DateTimeProperty(indexed=False)
     expired = ndb.DateTimeProperty()
 
 
+# indexed: email (get_user_by_email, admin users list), verified (admin users list), sessions.token_hash
+# (verify_session); sessions.expired is indexed too, because Session entities are queried by it
 class User(ndb.Model):
     email = ndb.StringProperty()
-    password = ndb.StringProperty()
+    password = ndb.TextProperty()
 
-    # Verification
-    verification_code = ndb.StringProperty()
-    verification_code_expiration = ndb.DateTimeProperty()
+    # Verification (the verification code is stored as a OneTimeCode entity)
     verified = ndb.BooleanProperty(default=False)
 
-    # Password change
-    password_change_code = ndb.StringProperty()
-    password_change_code_expiration = ndb.DateTimeProperty()
-    new_password = ndb.StringProperty()
+    # Password change (the confirmation code is stored as a OneTimeCode entity)
+    new_password = ndb.TextProperty()
 
-    # Forgot password
-    password_forgot_code = ndb.StringProperty()
-    password_forgot_code_expiration = ndb.DateTimeProperty()
+    # LEGACY: codes stored in the User entity before OneTimeCode entities, only read by the one-time-codes migration
+    # (remove these properties once it has run)
+    verification_code = ndb.TextProperty()
+    verification_code_expiration = ndb.DateTimeProperty(indexed=False)
+    password_change_code = ndb.TextProperty()
+    password_change_code_expiration = ndb.DateTimeProperty(indexed=False)
+    password_forgot_code = ndb.TextProperty()
+    password_forgot_code_expiration = ndb.DateTimeProperty(indexed=False)
 
-    # Connection with other two classes
+    # Connection with other class (CSRF tokens are signed and not stored, see generate_csrf_token)
     sessions = ndb.StructuredProperty(Session, repeated=True)
-    csrf_tokens = ndb.StructuredProperty(CSRFToken, repeated=True)
 
     # HANDLER METHODS:
     # grouped by meaning
 
     # USERS:
+    # users are keyed by their normalized e-mail address
+    @staticmethod
+    def normalize_email(email):
+        import bleach  # imported on first use, it takes a noticeable part of the cold start
+
+        # sanitize email
+        return bleach.clean(email, strip=True).strip().lower()
+
     # creates a new user
     @classmethod
     def create(cls, email, password):
-        with client.context():
-            # sanitize email
-            email = bleach.clean(email, strip=True)
+        with db_context():
+            # checks if user with this email already exists (with the e-mail as entered, see get_user_by_email)
+            user = cls.get_user_by_email(email)
 
-            # checks if user with this email already exists
-            user = cls.query(cls.email == email).get()
+            email = cls.normalize_email(email)
 
             if not user:  # if user does not yet exist, create one
                 if password:
                     # use bcrypt to hash the password
-                    hashed = bcrypt.hashpw(password.encode('utf8'), bcrypt.gensalt())
-                    password_hash = hashed.decode('utf8')
+                    password_hash = hash_password(password)
+
+                    # create the user object and store it into Datastore (in a transaction, so two registrations
+                    # with the same e-mail at the same time can't both succeed)
+                    @ndb.transactional()
+                    def create_user():
+                        if cls.get_by_id(email):
+                            return None
+
+                        new_user = cls(id=email, email=email, password=password_hash)
+                        new_user.put()
+
+                        return new_user
 
-                    # create the user object and store it into Datastore
-                    user = cls(email=email, password=password_hash)
-                    user.put()
+                    user = create_user()
 
-                    return True, user, "Success"  # success, user, message
+                    if user:
+                        return True, user, "Success"  # success, user, message
+                    else:
+                        return False, cls.get_by_id(email), "User with this email address is already registered. " \
+                                                            "Please go to the Login page and try to log in."
             else:
                 return False, user, "User with this email address is already registered. Please go to the " \
                                     "Login page and try to log in."
@@ -86,20 +149,14 @@ class User(ndb.Model):
         if not user:
             return False
 
-        with client.context():
+        with db_context():
             # generate confirmation code
-            code = secrets.token_hex()
-
-            # store it in user
-            user.password_change_code = hashlib.sha256(str.encode(code)).hexdigest()
-            user.password_change_code_expiration = datetime.datetime.now() + datetime.timedelta(hours=24)
+            code = OneTimeCode.create(user, OneTimeCode.PASSWORD_CHANGE)
 
             # store new password in temporary user field
-            hashed = bcrypt.hashpw(new_password.encode('utf8'), bcrypt.gensalt())
-            password_hash = hashed.decode('utf8')
-            user.new_password = password_hash
+            user.new_password = hash_password(new_password)
 
-            user.put()
+            unit_of_work.save(user)
 
             url = request.url_root
             complete_url = url + "change-password-confirmation/" + code
@@ -120,23 +177,17 @@ class User(ndb.Model):
     @classmethod
     def change_password_code_confirmation(cls, code):
         if not code:
-            return False
+            return False, None, None, "That confirmation code is not valid."
 
-        with client.context():
+        with db_context():
             email_ready = False
 
-            # verify verification code
-            code_hash = hashlib.sha256(str.encode(code)).hexdigest()
+            # verify confirmation code
+            one_time_code = OneTimeCode.get_valid(code, OneTimeCode.PASSWORD_CHANGE)
+            user = one_time_code.user_key.get() if one_time_code else None
 
-            user = cls.query(cls.password_change_code == code_hash).get()
-
-            if not user:
-                return False, "That confirmation code is not valid."
-
-            if user.password_change_code_expiration > datetime.datetime.now():
-                user.password_change_code = ""
-                user.password_change_code_expiration = datetime.datetime.min
-                user.put()
+            if user:
+                OneTimeCode.delete_code(code)
 
                 new_password_hash = user.new_password
                 url = request.url_root
@@ -154,7 +205,7 @@ class User(ndb.Model):
                        non_html_message=message_body)
             return True, user, new_password_hash, "Success"
         else:
-            return False, "That confirmation code is not valid."
+            return False, None, None, "That confirmation code is not valid."
 
     # sends confirmation link to e-mail for forgotten password
     @classmethod
@@ -162,14 +213,9 @@ class User(ndb.Model):
         if not user:
             return False
 
-        with client.context():
+        with db_context():
             # generate confirmation code
-            code = secrets.token_hex()
-
-            # store it in user
-            user.password_forgot_code = hashlib.sha256(str.encode(code)).hexdigest()
-            user.password_forgot_code_expiration = datetime.datetime.now() + datetime.timedelta(hours=24)
-            user.put()
+            code = OneTimeCode.create(user, OneTimeCode.PASSWORD_FORGOT)
 
             url = request.url_root
             complete_url = url + "forgot-password-confirmation/" + code
@@ -190,31 +236,27 @@ class User(ndb.Model):
     @classmethod
     def forgot_password_code_confirmation(cls, code):
         if not code:
-            return False
+            return False, None, "That confirmation code is not valid."
 
-        with client.context():
-            # verify verification code
-            code_hash = hashlib.sha256(str.encode(code)).hexdigest()
-
-            user = cls.query(cls.password_forgot_code == code_hash).get()
+        with db_context():
+            # verify confirmation code
+            one_time_code = OneTimeCode.get_valid(code, OneTimeCode.PASSWORD_FORGOT)
+            user = one_time_code.user_key.get() if one_time_code else None
 
             if not user:
-                return False, user, "That confirmation code is not valid."
+                return False, None, "That confirmation code is not valid."
 
-            if user.password_forgot_code_expiration > datetime.datetime.now():
-                return True, user, "Success"
+            return True, user, "Success"
 
     # sends e-mail that password was reset from forgot password
     @classmethod
-    def forgot_password_success(cls, user):
+    def forgot_password_success(cls, user, code):
         if not user:
             return False
 
-        with client.context():
-            # delete temporary fields
-            user.password_forgot_code = ""
-            user.password_forgot_code_expiration = datetime.datetime.min
-            user.put()
+        with db_context():
+            # the confirmation code can't be used again
+            OneTimeCode.delete_code(code)
 
             url = request.url_root
 
@@ -232,74 +274,99 @@ class User(ndb.Model):
     # updates user password
     @classmethod
     def update_password(cls, user, new_password_hash):
-        with client.context():
+        with db_context():
             if user and new_password_hash:
                 # set new password (that is already hashed) and delete temporary field
                 user.password = new_password_hash
                 user.new_password = ""
-                user.put()
+                unit_of_work.save(user)
+
+                # links sent before (change password or forgot password) can't change the password again
+                unit_of_work.delete(OneTimeCode.get_user_codes_keys(user.key, OneTimeCode.PASSWORD_PURPOSES))
+
+                # all cached sessions of this user must be verified against Datastore again
+                unit_of_work.on_flush(lambda: session_cache.delete_where(
+                    lambda token_hash, cached: cached[0] == user.key))
 
                 return True, "Successfully changed password"
             else:
                 return False, "Unknown error"
 
-    # CSRF TOKENS:
-    # generates CSRF token
+    # re-hashes the password (after a successful login) if it was hashed with a different cost than the current one
     @classmethod
-    def generate_csrf_token(cls, user):
-        with client.context():
-            valid_tokens = []
-            for csrf in user.csrf_tokens:
-                if csrf.expired > datetime.datetime.now():
-                    valid_tokens.append(csrf)
+    def rehash_password_if_needed(cls, user, password):
+        if not user or not password_policy.needs_rehash(user.password):
+            return False
 
-            # there should be maximum 10 CSRF tokens per user and not more, check and delete oldest one
-            if len(valid_tokens) >= 10:
-                oldest_token = min(valid_tokens, key=attrgetter("expired"))
-                valid_tokens.remove(oldest_token)
+        with db_context():
+            user.password = hash_password(password)
+            unit_of_work.save(user)
 
-            # generate csrf token and save it to CSRF table
-            csrf_token = secrets.token_hex()
+        return True
 
-            csrf_object = CSRFToken(token=csrf_token, expired=(datetime.datetime.now() + datetime.timedelta(hours=3)))
-            valid_tokens.append(csrf_object)
+    # CSRF TOKENS:
+    # generates a CSRF token: "<expiration>.<nonce>.<signature>", signed for this user and session. Tokens are not
+    # stored, so generating and validating them doesn't write to the Datastore.
+    @classmethod
+    def generate_csrf_token(cls, user, session_token):
+        if not user or not session_token:
+            return None
 
-            # finally, store the new tokens list back in the user model
-            user.csrf_tokens = valid_tokens
-            user.put()
+        expires = int(time.time()) + CSRF_TOKEN_HOURS * 3600
+        value = "{0}.{1}".format(expires, secrets.token_hex(8))
 
-            return csrf_token
+        return signing.sign(value, purpose=cls._csrf_purpose(user, session_token))
 
     # validates CSRF token
     @classmethod
-    def validate_csrf_token(cls, user, csrf_token):
-        with client.context():
-            token_validity = False
-
-            unused_tokens = []
-            for csrf in user.csrf_tokens:  # loop through user's CSRF tokens
-                if csrf.token == csrf_token:  # if tokens match, set validity to True
-                    token_validity = True
-                else:
-                    unused_tokens.append(csrf)  # if not, add CSRF token to the unused_tokens list
+    def validate_csrf_token(cls, user, session_token, csrf_token):
+        if not user or not session_token:
+            return False
 
-            if unused_tokens != user.csrf_tokens:
-                user.csrf_tokens = unused_tokens
-                user.put()
+        value = signing.unsign(csrf_token, purpose=cls._csrf_purpose(user, session_token))
+        if not value:
+            return False
 
-            return token_validity
+        try:
+            if int(value.partition(".")[0]) < time.time():
+                return False  # expired
+        except ValueError:
+            return False
+
+        # every token can be used only once (on this instance)
+        if csrf_replay_cache is not None:
+            if csrf_replay_cache.get(csrf_token):
+                return False
+
+            csrf_replay_cache.set(csrf_token, True)
+
+        return True
+
+    @staticmethod
+    def _csrf_purpose(user, session_token):
+        # the claim changes when it is refreshed, so only the session token is used
+        session_token, _ = User.split_session_cookie(session_token)
+
+        return "csrf|{0}|{1}".format(user.key.id(), hashlib.sha256(str.encode(session_token)).hexdigest())
 
     # SESSIONS:
     # generates a new session
     @classmethod
     def generate_session(cls, user):
-        with client.context():
+        with db_context():
             if user:
                 # generate session token and its hash
                 token = secrets.token_hex()
+
+                if SESSION_STORAGE == "entity":
+                    # the user key is a part of the token, so the session can be read with a get by key
+                    token = user.key.urlsafe().decode() + "." + token
+
                 token_hash = hashlib.sha256(str.encode(token)).hexdigest()
 
-                session = Session(token_hash=token_hash, expired=datetime.datetime.now() + datetime.timedelta(days=30))
+                now = datetime.datetime.now()
+                session = Session(token_hash=token_hash, created=now,
+                                  expired=now + datetime.timedelta(days=SESSION_DAYS))
                 if request:  # this separation is needed for tests which don't have the access to "request" variable
                     session.ip = request.access_route[-1]
                     session.platform = request.user_agent.platform
@@ -307,6 +374,13 @@ class User(ndb.Model):
                     session.user_agent = request.user_agent.string
                     session.country = request.headers.get("X-AppEngine-Country")
 
+                if SESSION_STORAGE == "entity":
+                    # store the session as its own entity (the User entity is not written at all)
+                    session.key = ndb.Key(Session, token_hash, parent=user.key)
+                    unit_of_work.save(session)
+
+                    return cls._session_cookie(user.key, token, session.expired)
+
                 if not user.sessions:
                     user.sessions = [session]
                 else:
@@ -317,57 +391,227 @@ class User(ndb.Model):
 
                     user.sessions = valid_sessions  # now only non-expired sessions are stored in the User object
 
-                user.put()
+                unit_of_work.save(user)
+
+                return cls._session_cookie(user.key, token, session.expired)
+
+    # returns the session cookie value: the session token (and a signed claim, if SESSION_CLAIMS is on)
+    @classmethod
+    def _session_cookie(cls, user_key, session_token, session_expired):
+        if not SESSION_CLAIMS:
+            return session_token
+
+        token_hash = hashlib.sha256(str.encode(session_token)).hexdigest()
+        expires = min(time.time() + SESSION_CLAIM_SECONDS, session_expired.timestamp())
+        claim = signing.sign("{0}.{1}".format(user_key.urlsafe().decode(), int(expires)),
+                             purpose="session|" + token_hash)
+
+        return session_token + ":" + claim
+
+    # returns the user key from a session claim (or None if the claim is not valid or has expired)
+    @staticmethod
+    def _read_session_claim(claim, token_hash):
+        value = signing.unsign(claim, purpose="session|" + token_hash)
+        if not value:
+            return None
+
+        user_key_urlsafe, _, expires = value.rpartition(".")
+
+        try:
+            if int(expires) < time.time():
+                return None
+
+            return ndb.Key(urlsafe=user_key_urlsafe)
+        except Exception:
+            return None
+
+    # splits the session cookie value into the session token and the session claim (empty without claims)
+    @staticmethod
+    def split_session_cookie(session_cookie):
+        session_token, _, claim = (session_cookie or "").partition(":")
+
+        return session_token, claim
+
+    # returns the key of a session entity from a session token which contains the user key ("<user key>.<token>")
+    @staticmethod
+    def _session_key(session_token, token_hash):
+        user_key_urlsafe, separator, token = session_token.partition(".")
+
+        if not separator:
+            return None  # a token of a session that is (or was) embedded in the User entity
+
+        try:
+            user_key = ndb.Key(urlsafe=user_key_urlsafe)
+        except Exception:
+            return None
+
+        # the Datastore rejects keys of other projects (the request would fail instead of not finding the session)
+        client = ndb.get_context().client
+        if user_key.kind() != "User" or user_key.project() != client.project or \
+                user_key.namespace() != client.namespace:
+            return None
 
-                return token
+        return ndb.Key(Session, token_hash, parent=user_key)
 
-    # verifies a session by session token
+    # verifies a session by the session cookie value
     @classmethod
     def verify_session(cls, session_token=None):
-        with client.context():
+        session_token, claim = cls.split_session_cookie(session_token)
+
+        with db_context():
+            if session_token and claim and SESSION_CLAIMS:
+                # a valid claim is enough, the session itself is not read (only the user is)
+                user_key = cls._read_session_claim(claim, hashlib.sha256(str.encode(session_token)).hexdigest())
+                user = user_key.get() if user_key else None
+
+                if user:
+                    return True, user, "Success"
+
+            success, user, message, expired = cls._verify_session_token(session_token)
+
+            if success and SESSION_CLAIMS and has_request_context():
+                # send a new claim with the response (unless the session is deleted in this request, see
+                # _cancel_session_claim)
+                if "session_claim" not in g:
+                    after_this_request(cls._refresh_session_claim)
+
+                g.session_claim = {"token_hash": hashlib.sha256(str.encode(session_token)).hexdigest(),
+                                   "user_key": user.key, "expired": expired,
+                                   "cookie": cls._session_cookie(user.key, session_token, expired)}
+
+            return success, user, message
+
+    # after_this_request callback of verify_session: sets the cookie with the new claim
+    @staticmethod
+    def _refresh_session_claim(response):
+        claim = g.pop("session_claim", None)
+
+        if claim:
+            response.set_cookie(SESSION_COOKIE, claim["cookie"], expires=claim["expired"])
+
+        return response
+
+    # a deleted session must not get a new claim (the response of a logout would log the user in again)
+    @staticmethod
+    def _cancel_session_claim(user_key, token_hash=None):
+        claim = g.get("session_claim") if has_request_context() else None
+
+        if claim and claim["user_key"] == user_key and token_hash in (None, claim["token_hash"]):
+            g.session_claim = None
+
+    # verifies a session by session token, returns (success, user, message, session expiration)
+    @classmethod
+    def _verify_session_token(cls, session_token):
+        with db_context():
             if session_token:
                 token_hash = hashlib.sha256(str.encode(session_token)).hexdigest()
 
+                # first check the session cache (a get by key is much cheaper than the query below)
+                cached = session_cache.get(token_hash)
+
+                if cached:
+                    user_key, expired = cached
+
+                    if expired > datetime.datetime.now():
+                        user = user_key.get()
+
+                        if user:
+                            return True, user, "Success", expired
+
+                    session_cache.delete(token_hash)
+
+                # sessions stored as separate entities are read with a (strongly consistent) get by key
+                session_key = cls._session_key(session_token, token_hash)
+
+                if session_key:
+                    session = session_key.get()
+
+                    if session:
+                        if session.expired > datetime.datetime.now():
+                            user = session_key.parent().get()
+
+                            if user:
+                                session_cache.set(token_hash, (user.key, session.expired))
+                                return True, user, "Success", session.expired
+
+                        return False, None, "Unknown error.", None
+
+                if SESSION_STORAGE == "entity":
+                    # older tokens don't contain the user key (or contain the key the user had before the email-keys
+                    # migration), but their sessions may already be stored as separate entities
+                    session = Session.query(Session.token_hash == token_hash).get()
+
+                    if session and session.expired > datetime.datetime.now():
+                        user = session.key.parent().get()
+
+                        if user:
+                            session_cache.set(token_hash, (user.key, session.expired))
+                            return True, user, "Success", session.expired
+
+                if session_key:  # these sessions are never embedded in the User entity
+                    return False, None, "A user with this session token does not exist. Try to log in again.", None
+
                 user = cls.query(cls.sessions.token_hash == token_hash).get()
 
                 if not user:
-                    return False, None, "A user with this session token does not exist. Try to log in again."
+                    return False, None, "A user with this session token does not exist. Try to log in again.", None
 
                 # important: you can't check for expiration in the cls.query() above, because it wouldn't only check the
                 # expiration date of the session in question, but any expiration date which could give a false result
                 for session in user.sessions:
                     if session.token_hash == token_hash:
                         if session.expired > datetime.datetime.now():
-                            return True, user, "Success"
+                            session_cache.set(token_hash, (user.key, session.expired))
+                            return True, user, "Success", session.expired
 
-                return False, None, "Unknown error."
+                return False, None, "Unknown error.", None
             else:
-                return False, None, "Please login to access this page."
+                return False, None, "Please login to access this page.", None
 
     # deletes session
     @classmethod
     def delete_session(cls, user, session_token):
-        with client.context():
+        session_token, _ = cls.split_session_cookie(session_token)
+
+        with db_context():
             cookie_token_hash = hashlib.sha256(str.encode(session_token)).hexdigest()
 
-            valid_sessions = []
-            for session in user.sessions:
-                # delete session that has the same session token than browser's session cookie
-                # (delete by not including in the new sessions list)
-                if session.token_hash != cookie_token_hash:
-                    valid_sessions.append(session)
+            if user.sessions:
+                valid_sessions = []
+                for session in user.sessions:
+                    # delete session that has the same session token than browser's session cookie
+                    # (delete by not including in the new sessions list)
+                    if session.token_hash != cookie_token_hash:
+                        valid_sessions.append(session)
+
+                if len(valid_sessions) != len(user.sessions):
+                    user.sessions = valid_sessions
+                    unit_of_work.save(user)
+
+            # delete the session entity (if the session is stored as a separate entity)
+            unit_of_work.delete([ndb.Key(Session, cookie_token_hash, parent=user.key)])
 
-            user.sessions = valid_sessions
-            user.put()
+            unit_of_work.on_flush(lambda: session_cache.delete(cookie_token_hash))
+
+        cls._cancel_session_claim(user.key, cookie_token_hash)
 
         return True
 
     # deletes all sessions from user (when password is changed)
     @classmethod
     def delete_all_user_sessions(cls, user):
-        with client.context():
-            user.sessions = []
-            user.put()
+        with db_context():
+            if user.sessions:
+                user.sessions = []
+                unit_of_work.save(user)
+
+            # sessions stored as separate entities are children of the User entity
+            unit_of_work.delete(Session.query(ancestor=user.key).fetch(keys_only=True))
+
+            unit_of_work.on_flush(lambda: session_cache.delete_where(
+                lambda token_hash, cached: cached[0] == user.key))
+
+        cls._cancel_session_claim(user.key)
 
         return True
 
@@ -378,14 +622,9 @@ class User(ndb.Model):
         if not user:
             return False
 
-        with client.context():
+        with db_context():
             # generate verification code
-            code = secrets.token_hex()
-
-            # store it in user
-            user.verification_code = hashlib.sha256(str.encode(code)).hexdigest()
-            user.verification_code_expiration = datetime.datetime.now() + datetime.timedelta(hours=24)
-            user.put()
+            code = OneTimeCode.create(user, OneTimeCode.VERIFICATION)
 
             url = request.url_root
             complete_url = url + "email-verification/" + code
@@ -408,21 +647,18 @@ class User(ndb.Model):
         if not code:
             return False
 
-        with client.context():
+        with db_context():
             email_ready = False
 
             # verify verification code
-            code_hash = hashlib.sha256(str.encode(code)).hexdigest()
+            one_time_code = OneTimeCode.get_valid(code, OneTimeCode.VERIFICATION)
+            user = one_time_code.user_key.get() if one_time_code else None
 
-            user = cls.query(cls.verification_code == code_hash).get()
-
-            if not user:
-                return False, "That verification code is not valid."
+            if user:
+                user.verified = True
+                unit_of_work.save(user)
 
-            if user.verification_code_expiration > datetime.datetime.now():
-                user.verification_code = ""
-                user.verification_code_expiration = datetime.datetime.min
-                user.put()
+                OneTimeCode.delete_code(code)
 
                 url = request.url_root
 
@@ -444,14 +680,310 @@ class User(ndb.Model):
     # FOR CRON JOBS:
     # remove users that did not verify their e-mail in one day period
     @classmethod
-    def remove_unverified_users(cls):
-        with client.context():
-            users_keys = cls.query(cls.verification_code != "",
-                                   cls.verification_code_expiration < datetime.datetime.now()).fetch(
-                keys_only=True)
+    def remove_unverified_users(cls, cursor=None, batch_size=100, time_budget=None):
+        # users whose verification code has expired are deleted in batches, until there are none left or until
+        # time_budget (seconds) runs out. Returns the number of deleted users, the cursor to continue from and
+        # whether there are more codes left.
+        deadline = time.monotonic() + time_budget if time_budget else None
+        deleted = 0
+
+        with db_context():
+            query = OneTimeCode.query(OneTimeCode.purpose == OneTimeCode.VERIFICATION,
+                                      OneTimeCode.expired < datetime.datetime.now())
+
+            start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+            more = True
+
+            while more:
+                codes, start_cursor, more = query.fetch_page(batch_size, start_cursor=start_cursor)
+
+                users = ndb.get_multi([code.user_key for code in codes])
+                users_keys = [user.key for user in users if user and not user.is_verified]
+
+                ndb.delete_multi(keys=users_keys + [code.key for code in codes])
+                deleted += len(users_keys)
+
+                if deadline and time.monotonic() > deadline:
+                    break
+
+            # the cursor is returned as a string, so it can be sent to the next task
+            next_cursor = start_cursor.urlsafe().decode() if more and start_cursor else None
+
+            return deleted, next_cursor, more
+
+    # removes expired sessions from User entities (otherwise they are only removed when the same user logs in again)
+    # and deletes expired Session entities. Runs in batches until everything is done or until time_budget (seconds)
+    # runs out. Returns the number of compacted users, the estimated number of bytes reclaimed from them (see
+    # _sessions_size), the number of deleted Session entities, the cursor to continue from and whether there are more
+    # users left.
+    @classmethod
+    def remove_expired_sessions(cls, cursor=None, batch_size=50, time_budget=None):
+        deadline = time.monotonic() + time_budget if time_budget else None
+        compacted = 0
+        reclaimed = 0
+        deleted = 0
+
+        @ndb.transactional(xg=True)
+        def compact_users(users_keys):
+            now = datetime.datetime.now()
+            changed = []
+            size = 0
+
+            for user in ndb.get_multi(users_keys):
+                if not user:
+                    continue
+
+                sessions, expired = [], []
+                for item in user.sessions:
+                    (sessions if item.expired and item.expired > now else expired).append(item)
+
+                if expired:
+                    size += cls._sessions_size(expired)
+
+                    user.sessions = sessions
+                    changed.append(user)
+
+            ndb.put_multi(changed)
+
+            return len(changed), size
+
+        with db_context():
+            # expired Session entities (deleted ones are not returned again, so no cursor is needed)
+            query = Session.query(Session.expired < datetime.datetime.now())
+
+            while True:
+                sessions_keys = query.fetch(batch_size, keys_only=True)
+                ndb.delete_multi(sessions_keys)
+                deleted += len(sessions_keys)
+
+                if len(sessions_keys) < batch_size:
+                    break
+
+                if deadline and time.monotonic() > deadline:
+                    return compacted, reclaimed, deleted, cursor, True
+
+            # sessions embedded in User entities
+            start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+            more = True
+
+            while more:
+                users_keys, start_cursor, more = cls.query().fetch_page(batch_size, start_cursor=start_cursor,
+                                                                        keys_only=True)
+
+                changed, size = compact_users(users_keys)
+                compacted += changed
+                reclaimed += size
+
+                if deadline and time.monotonic() > deadline:
+                    break
+
+            # the cursor is returned as a string, so it can be sent to the next task
+            next_cursor = start_cursor.urlsafe().decode() if more and start_cursor else None
+
+            return compacted, reclaimed, deleted, next_cursor, more
+
+    # estimated size of sessions embedded in a User entity (in bytes): the length of every property name and value,
+    # dates count as 8 bytes. The stored entity is a bit bigger (encoding overhead), so this is only an estimate.
+    @staticmethod
+    def _sessions_size(sessions):
+        size = 0
+
+        for session in sessions:
+            for name, value in session.to_dict().items():
+                size += len("sessions." + name) + (8 if isinstance(value, datetime.datetime) else len(value or ""))
+
+        return size
+
+    # EXPORT:
+    # yields a dict for every user (e-mail, verified flag, number of valid sessions and last login). Users are read
+    # in batches, so memory use doesn't grow with the number of users. Every row also has the cursor after its user,
+    # so an interrupted export can be resumed from the last row received.
+    @classmethod
+    def export(cls, cursor=None, batch_size=100):
+        with db_context():
+            start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+            iterator = cls.query().iter(start_cursor=start_cursor)
+
+            batch = []
+            while iterator.has_next():
+                batch.append((iterator.next(), iterator.cursor_after().urlsafe().decode()))
+
+                if len(batch) == batch_size:
+                    yield from cls._export_batch(batch)
+                    batch = []
+
+            yield from cls._export_batch(batch)
+
+    @classmethod
+    def _export_batch(cls, batch):
+        # session entities of the whole batch are queried at the same time
+        session_entities = {}
+        if SESSION_STORAGE == "entity":
+            futures = [(user.key, Session.query(ancestor=user.key).fetch_async()) for user, _ in batch]
+            session_entities = {user_key: future.result() for user_key, future in futures}
+
+        now = datetime.datetime.now()
+        for user, cursor in batch:
+            sessions = [item for item in (user.sessions or []) + session_entities.get(user.key, []) if item.expired]
+
+            # sessions created before the "created" property was added: derived from their expiration
+            logins = [item.created or item.expired - datetime.timedelta(days=SESSION_DAYS) for item in sessions]
+
+            yield {
+                "email": user.email,
+                "verified": user.is_verified,
+                "sessions": len([item for item in sessions if item.expired > now]),
+                "last_login": max(logins).isoformat() if logins else None,
+                "cursor": cursor,
+            }
+
+    # MIGRATIONS:
+    # moves sessions embedded in User entities to separate Session entities (one batch of users per call)
+    @classmethod
+    def migrate_embedded_sessions(cls, cursor=None, batch_size=50):
+        @ndb.transactional()
+        def migrate_user_sessions(user_key):
+            user = user_key.get()
+
+            if not user or not user.sessions:
+                return 0
+
+            # expired sessions are not migrated
+            sessions = [Session(id=item.token_hash, parent=user.key, **item.to_dict()) for item in user.sessions
+                        if item.expired > datetime.datetime.now()]
+
+            user.sessions = []
+            ndb.put_multi(sessions + [user])
+
+            return len(sessions)
+
+        return cls._migrate_in_batches(migrate_user_sessions, cursor, batch_size)
+
+    # rekeys users created before users were keyed by e-mail (one batch of users per call)
+    @classmethod
+    def migrate_email_keys(cls, cursor=None, batch_size=50):
+        @ndb.transactional(xg=True)
+        def rekey_user(user_key):
+            user = user_key.get()
+
+            if not user:
+                return None
+
+            email = cls.normalize_email(user.email)
+            new_key = ndb.Key(cls, email)
 
-            ndb.delete_multi(keys=users_keys)
-            return True
+            if new_key.get():
+                logging.warning("User {0} was not rekeyed, because another user with e-mail {1} already "
+                                "exists.".format(user_key.id(), email))
+                return None
+
+            # sessions stored as separate entities have to move with the user (they are its children)
+            sessions = Session.query(ancestor=user_key).fetch()
+
+            user.key = new_key
+            user.email = email
+
+            for session in sessions:
+                session.key = ndb.Key(Session, session.key.id(), parent=new_key)
+
+            ndb.put_multi([user] + sessions)
+            ndb.delete_multi([user_key] + [ndb.Key(Session, session.key.id(), parent=user_key)
+                                           for session in sessions])
+
+            return new_key
+
+        def migrate_user(user_key):
+            if not isinstance(user_key.id(), int):  # users keyed by e-mail have a string ID
+                return 0
+
+            new_key = rekey_user(user_key)
+
+            if not new_key:
+                return 0
+
+            # codes sent to the user must point to the new key (queries can't run in the transaction above)
+            codes = OneTimeCode.query(OneTimeCode.user_key == user_key).fetch()
+
+            for code in codes:
+                code.user_key = new_key
+
+            ndb.put_multi(codes)
+
+            return 1
+
+        return cls._migrate_in_batches(migrate_user, cursor, batch_size)
+
+    # moves codes stored in User entities to OneTimeCode entities and sets the verified flag (one batch of users per
+    # call)
+    @classmethod
+    def migrate_one_time_codes(cls, cursor=None, batch_size=50):
+        legacy_codes = [("verification_code", "verification_code_expiration", OneTimeCode.VERIFICATION),
+                        ("password_change_code", "password_change_code_expiration", OneTimeCode.PASSWORD_CHANGE),
+                        ("password_forgot_code", "password_forgot_code_expiration", OneTimeCode.PASSWORD_FORGOT)]
+
+        @ndb.transactional(xg=True)
+        def migrate_user_codes(user_key):
+            user = user_key.get()
+
+            if not user or user.verification_code is None:  # new or already migrated user
+                return 0
+
+            user.verified = user.is_verified
+
+            # the stored code hashes become the keys of OneTimeCode entities
+            codes = []
+            for code_field, expiration_field, purpose in legacy_codes:
+                if getattr(user, code_field):
+                    codes.append(OneTimeCode(id=getattr(user, code_field), purpose=purpose, user_key=user.key,
+                                             expired=getattr(user, expiration_field)))
+
+                setattr(user, code_field, None)
+                setattr(user, expiration_field, None)
+
+            ndb.put_multi(codes + [user])
+
+            return len(codes)
+
+        return cls._migrate_in_batches(migrate_user_codes, cursor, batch_size)
+
+    # re-saves users (and their Session entities) with the current index policy, so index rows of properties that
+    # aren't indexed anymore are deleted (one batch of users per call). Properties that aren't a part of the models
+    # anymore (e.g. the CSRF tokens stored by older versions of the app) are not written back, so they are removed too.
+    @classmethod
+    def migrate_index_policy(cls, cursor=None, batch_size=50):
+        @ndb.transactional()
+        def resave_user(user_key):
+            user = user_key.get()
+
+            if not user:
+                return 0
+
+            sessions = Session.query(ancestor=user_key).fetch()
+            ndb.put_multi([user] + sessions)
+
+            return 1 + len(sessions)
+
+        # all users are re-saved: ndb can't filter on the old "csrf_tokens.expired" property (names with periods are
+        # not allowed) and drops it when a user is loaded, so users with stored tokens can't be told apart
+        return cls._migrate_in_batches(resave_user, cursor, batch_size)
+
+    # runs migrate_user (returns the number of migrated items) for every user of one batch, starting at the cursor.
+    # Returns the number of migrated items, the cursor of the next batch and whether there are more users left.
+    @classmethod
+    def _migrate_in_batches(cls, migrate_user, cursor, batch_size):
+        with db_context():
+            start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+            users_keys, next_cursor, more = cls.query().fetch_page(batch_size, start_cursor=start_cursor,
+                                                                    keys_only=True)
+
+            migrated = 0
+            for user_key in users_keys:
+                migrated += migrate_user(user_key)
+
+            # the cursor is returned as a string, so it can be sent to the next task
+            next_cursor = next_cursor.urlsafe().decode() if next_cursor else None
+
+            return migrated, next_cursor, more
 
     # RETRIEVE DATA:
     # gets ID from itself
@@ -462,15 +994,70 @@ class User(ndb.Model):
     # retrieves user by email
     @classmethod
     def get_user_by_email(cls, email):
-        with client.context():
-            user = cls.query(cls.email == email).get()
+        with db_context():
+            normalized_email = cls.normalize_email(email)
+            user = cls.get_by_id(normalized_email)
+
+            if not user and LEGACY_EMAIL_LOOKUP:
+                # users registered before users were keyed by e-mail (see the email-keys migration) have the e-mail
+                # stored as it was entered, so both the entered and the normalized e-mail are looked up
+                user = cls.query(cls.email.IN(sorted({email, email.strip(), normalized_email}))).get()
 
             return user
 
-    # retrieves ALL verified users
+    # users created before OneTimeCode entities don't have the verified flag set yet (see the one-time-codes migration)
+    @property
+    def is_verified(self):
+        return self.verified or self.verification_code == ""
+
+    # retrieves one page of verified users (e-mail only), ordered by e-mail. Cursors are opaque strings that mark
+    # the e-mail the page starts after ("next") or ends before ("prev"), so every page costs the same no matter how
+    # many users come before it. Returns (users, prev_cursor, next_cursor).
     @classmethod
-    def fetch(cls, verification_code=""):
-        with client.context():
-            users = cls.query(cls.verification_code == verification_code).fetch()
+    def fetch_page(cls, page_size=DEFAULT_PAGE_SIZE, cursor=None):
+        page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+        direction, boundary = cls._decode_page_cursor(cursor)
+
+        with db_context():
+            query = cls.query(cls.verified == True)  # noqa: E712
+
+            if direction == "prev":
+                query = query.filter(cls.email < boundary).order(-cls.email)
+            else:
+                if boundary is not None:
+                    query = query.filter(cls.email > boundary)
+                query = query.order(cls.email)
+
+            # one more than needed, to know if there is another page
+            users = query.fetch(page_size + 1, projection=[cls.email])
+
+        has_more = len(users) > page_size
+        users = users[:page_size]
+
+        if direction == "prev":
+            users.reverse()
+            has_prev, has_next = has_more, True
+        else:
+            has_prev, has_next = boundary is not None, has_more
+
+        prev_cursor = cls._encode_page_cursor("prev", users[0].email) if users and has_prev else None
+        next_cursor = cls._encode_page_cursor("next", users[-1].email) if users and has_next else None
+
+        return users, prev_cursor, next_cursor
+
+    @staticmethod
+    def _encode_page_cursor(direction, email):
+        return base64.urlsafe_b64encode("{0}:{1}".format(direction, email).encode()).decode()
+
+    # returns (direction, e-mail), or ("next", None) for the first page (or an invalid cursor)
+    @staticmethod
+    def _decode_page_cursor(cursor):
+        try:
+            direction, email = base64.urlsafe_b64decode(cursor.encode()).decode().split(":", 1)
+        except (AttributeError, ValueError):
+            return "next", None
+
+        if direction not in ("prev", "next"):
+            return "next", None
 
-            return users
+        return direction, email
@@ -35,18 +35,24 @@ os.environ["FLASK_APP"] = "main.py"
 main_command = "flask run --host localhost --port 8080 --reload"
 storage = "--data-dir=."
 
-# Run datastore emulator
-emulator_command = 'gcloud beta emulators datastore start --consistency=1 {storage} --project test ' \
-                   '--host-port "localhost:{port}"'.format(storage=storage, port=emulator_port)
-run_datastore = os.popen(emulator_command)
-
-# wait for the Emulator to start
-print("Checking if emulator has started yet...")
-while not emulator_started(port=emulator_port):
-    print("Emulator hasn't started yet. Let's wait 5 seconds and check again. (It may take a while, so please be patient.)")
-    time.sleep(5)
-
-print("Yaaay, the emulator is on! Now we can start our {}.".format(text_bottom))
+run_datastore = None
+
+if os.environ.get("DATASTORE_BACKEND") == "memory":
+    # the data is kept in the memory of the web app (and lost when it stops or reloads), no emulator is needed
+    print("Using the in-memory Datastore, the emulator won't be started.")
+else:
+    # Run datastore emulator
+    emulator_command = 'gcloud beta emulators datastore start --consistency=1 {storage} --project test ' \
+                       '--host-port "localhost:{port}"'.format(storage=storage, port=emulator_port)
+    run_datastore = os.popen(emulator_command)
+
+    # wait for the Emulator to start
+    print("Checking if emulator has started yet...")
+    while not emulator_started(port=emulator_port):
+        print("Emulator hasn't started yet. Let's wait 5 seconds and check again. (It may take a while, so please be patient.)")
+        time.sleep(5)
+
+    print("Yaaay, the emulator is on! Now we can start our {}.".format(text_bottom))
 
 # Run the main command, which is web app
 run_main_command = os.popen(main_command)
@@ -0,0 +1,39 @@
+import json
+import logging
+from flask import request, url_for
+from models.user import User
+from utils.environment import is_local
+from utils.task_helper import run_background_task
+
+
+# data migrations that can be run by this task; each one processes one batch of users and returns the number of
+# migrated items, the cursor of the next batch and whether there are more users left
+MIGRATIONS = {
+    "embedded-sessions": User.migrate_embedded_sessions,
+    "email-keys": User.migrate_email_keys,
+    "one-time-codes": User.migrate_one_time_codes,
+    "index-policy": User.migrate_index_policy,
+    "csrf-tokens": User.migrate_index_policy,  # the index-policy migration removes stored CSRF tokens too
+}
+
+
+def migrate_users(migration):
+    """A background task that runs a data migration over all users, one batch per task."""
+    if migration not in MIGRATIONS:
+        return "Unknown migration: " + migration, 404
+
+    # same as with other tasks, the X-AppEngine-QueueName header can only be set by Google Cloud Tasks
+    if not request.headers.get("X-AppEngine-QueueName") and not is_local():
+        return "Forbidden", 403
+
+    data = json.loads(request.get_data(as_text=True) or "{}")
+
+    migrated, next_cursor, more = MIGRATIONS[migration](cursor=data.get("cursor"))
+    logging.info("Migration {0}: migrated {1} items in this batch.".format(migration, migrated))
+
+    # continue with the next batch in a new task
+    if more and next_cursor:
+        run_background_task(relative_path=url_for("tasks.migrate_users_task.migrate_users", migration=migration),
+                            payload={"cursor": next_cursor}, queue="default")
+
+    return "Migrated {0} items".format(migrated)
@@ -1,54 +1,62 @@
 import json
 import logging
-from flask import request
-from sendgrid import SendGridAPIClient, Mail
-from models.settings import Settings
+import os
+from flask import request, jsonify, url_for
+from utils.email_renderer import get_renderer
 from utils.environment import is_local
+from utils.sendgrid_sender import get_sender
+from utils.task_helper import run_background_task
 
 
 def send_email_via_sendgrid():
-    """A background task that sends an email via SendGrid."""
+    """A background task that sends one email (or a batch of emails in "messages") via SendGrid."""
     data = json.loads(request.get_data(as_text=True))
 
-    recipient_email = data.get("recipient_email")
-    sender_email = data.get("sender_email")
-    email_subject = data.get("email_subject")
-    email_body = data.get("email_body")
-    non_html_message = data.get("non_html_message")
+    messages = data.get("messages") or [data]
+
+    # render the email HTML bodies (tasks enqueued by older versions of the app already contain them)
+    for message in messages:
+        if not message.get("email_body") and message.get("email_template"):
+            message["email_body"] = get_renderer().render(message["email_template"],
+                                                          **(message.get("email_params") or {}))
 
     if is_local():
         # localhost (not really sending the email)
-
-        logging.warning("***********************")
-        logging.warning("You are on localhost, so no e-mail will be sent. This is message:")
-        logging.warning("Recipient: " + recipient_email)
-        logging.warning("Sender: " + sender_email)
-        logging.warning("Subject: " + email_subject)
-        logging.warning("Body: " + non_html_message)
-        logging.warning("+++++++++++++++++++++++")
-
-        return "{sender_email} {email_subject}".format(sender_email=sender_email, email_subject=email_subject)
+        for message in messages:
+            logging.warning("***********************")
+            logging.warning("You are on localhost, so no e-mail will be sent. This is message:")
+            logging.warning("Recipient: " + message.get("recipient_email"))
+            logging.warning("Sender: " + message.get("sender_email"))
+            logging.warning("Subject: " + message.get("email_subject"))
+            logging.warning("Body: " + message.get("non_html_message"))
+            logging.warning("+++++++++++++++++++++++")
+
+        return jsonify([{"recipient_email": message.get("recipient_email"), "success": True, "error": None}
+                        for message in messages])
     else:
         # production (sending the email via SendGrid)
         if request.headers.get("X-AppEngine-QueueName"):
             # If the request has this header (X-AppEngine-QueueName), then it really came from Google Cloud Tasks.
             # Third-party requests that contain headers started with X are stripped of these headers once they hit GAE
             # servers. That's why no one can fake these headers.
+            results = get_sender().send(messages)
+
+            sent = len([result for result in results if result["success"]])
+            logging.info("Sent {0} of {1} e-mails.".format(sent, len(results)))
+
+            # if nothing could be sent (e.g. SendGrid is down), let Cloud Tasks retry the task later
+            if not sent and results:
+                return jsonify(results), 500
+
+            # if only some e-mails could be sent, the others are retried in a new task (retrying this task would send
+            # the sent ones again). Every new task has fewer messages, so this ends once nothing more can be sent.
+            failed = [message for message, result in zip(messages, results) if not result["success"]]
+
+            if failed:
+                run_background_task(relative_path=url_for("tasks.send_email_task.send_email_via_sendgrid"),
+                                    payload={"messages": failed}, queue="email",
+                                    project=os.environ.get("GOOGLE_CLOUD_PROJECT"), location="europe-west1")
 
-            # SendGrid setup
-            sg_api_key = Settings.get_by_name("SendGrid-Mail")
-            sg = SendGridAPIClient(api_key=sg_api_key.value)
-
-            # Set up email message
-            email_message = Mail(from_email=sender_email, to_emails=recipient_email, subject=email_subject,
-                                 html_content=email_body)
-
-            try:
-                response = sg.send(email_message)
-                logging.info(response.status_code)
-                logging.info(response.body)
-                logging.info(response.headers)
-            except Exception as e:
-                logging.error(str(e))
+            return jsonify(results), 200
 
         return "true"
@@ -0,0 +1,83 @@
+import os
+
+# the app is configured when it's imported: the in-memory Datastore (no emulator needed) and a low bcrypt cost
+os.environ["TESTING"] = "yes"
+os.environ["DATASTORE_BACKEND"] = "memory"
+os.environ["BCRYPT_ROUNDS"] = "4"
+
+import re  # noqa: E402
+
+import pytest  # noqa: E402
+
+import models.user  # noqa: E402
+from main import app as flask_app  # noqa: E402
+from models import db_context, settings  # noqa: E402
+from models.global_cache import get_global_cache  # noqa: E402
+from models.memory_datastore import get_stub  # noqa: E402
+from models.user import User  # noqa: E402
+from utils import rate_limit  # noqa: E402
+from utils.password_helper import hash_password  # noqa: E402
+
+
+PASSWORD = "test-password"
+
+
+@pytest.fixture(autouse=True)
+def datastore():
+    """Every test starts with an empty Datastore and empty caches."""
+    get_stub().clear()
+    get_global_cache().clear()
+    models.user.session_cache.clear()
+    if models.user.csrf_replay_cache is not None:
+        models.user.csrf_replay_cache.clear()
+    settings._cache["settings"] = None
+    rate_limit._store = None
+
+    with db_context() as context:
+        yield context
+
+
+@pytest.fixture
+def app():
+    return flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def emails(monkeypatch):
+    """E-mails sent by the User model (instead of enqueueing them), as a list of send_email keyword arguments."""
+    sent = []
+    monkeypatch.setattr(models.user, "send_email", lambda **kwargs: sent.append(kwargs))
+    return sent
+
+
+@pytest.fixture(params=["embedded", "entity", "claims"])
+def session_mode(request, monkeypatch):
+    """Runs the test with sessions embedded in User entities, stored as Session entities and with signed claims."""
+    monkeypatch.setattr(models.user, "SESSION_STORAGE", "entity" if request.param == "entity" else "embedded")
+    monkeypatch.setattr(models.user, "SESSION_CLAIMS", request.param == "claims")
+    return request.param
+
+
+# returns the code from the link in the last e-mail
+def code_from(emails):
+    return re.search(r"/([0-9a-f]{64})$", emails[-1]["email_params"]["email_url"]).group(1)
+
+
+def create_user(email="user@example.com", password=PASSWORD, verified=True):
+    user = User(id=User.normalize_email(email), email=email, password=hash_password(password), verified=verified)
+    user.put()
+    return user
+
+
+def login(client, email="user@example.com", password=PASSWORD):
+    return client.post("/", data={"email": email, "password": password})
+
+
+def is_logged_in(client, email="user@example.com"):
+    response = client.get("/admin/users")
+    return response.status_code == 200 and email.encode() in response.data
@@ -0,0 +1,38 @@
+import csv
+import io
+import json
+
+import pytest
+
+from tests.conftest import create_user, login
+
+
+@pytest.fixture
+def logged_in(client):
+    for number in range(5):
+        create_user("user-{0}@example.com".format(number))
+
+    login(client, "user-0@example.com")
+
+
+def test_users_list_pages(client, logged_in):
+    response = client.get("/admin/users?page_size=2")
+    page = response.get_data(as_text=True)
+
+    assert "user-0@example.com" in page and "user-1@example.com" in page and "user-2@example.com" not in page
+
+
+def test_export_csv(client, logged_in):
+    rows = list(csv.DictReader(io.StringIO(client.get("/admin/users/export").get_data(as_text=True))))
+
+    assert [row["email"] for row in rows] == ["user-{0}@example.com".format(number) for number in range(5)]
+    assert rows[0]["sessions"] == "1"
+
+
+def test_export_resumes_from_cursor(client, logged_in):
+    rows = [json.loads(line) for line in client.get("/admin/users/export?format=ndjson").data.splitlines()]
+
+    response = client.get("/admin/users/export", query_string={"format": "ndjson", "cursor": rows[1]["cursor"]})
+    resumed = [json.loads(line)["email"] for line in response.data.splitlines()]
+
+    assert resumed == ["user-2@example.com", "user-3@example.com", "user-4@example.com"]
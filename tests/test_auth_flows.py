@@ -0,0 +1,240 @@
+import re
+
+import pytest
+from google.cloud import ndb
+
+import models.user
+from models.memory_datastore import get_stub
+from models.user import User
+from tests.conftest import PASSWORD, code_from, create_user, is_logged_in, login
+from utils.password_helper import hash_password
+
+
+@pytest.fixture(autouse=True)
+def modes(session_mode, emails):
+    """Every test here runs in all session modes (embedded, entity and claims)."""
+
+
+# submits the change password form (with the CSRF token from the page)
+def request_password_change(client, new_password):
+    response = client.get("/change-password")
+    csrf_token = re.search(r'name="csrf_token" value="([^"]+)"', response.get_data(as_text=True)).group(1)
+
+    return client.post("/change-password", data={"current_password": PASSWORD, "new_password": new_password,
+                                                  "csrf_token": csrf_token})
+
+
+@pytest.fixture
+def commits(monkeypatch):
+    """The commit requests (writes) sent to the in-memory Datastore."""
+    sent = []
+    commit = get_stub().commit
+    function = commit.function
+    monkeypatch.setattr(commit, "function", lambda request: sent.append(request) or function(request))
+    return sent
+
+
+def test_registration_and_email_verification(client, emails):
+    response = client.post("/registration", data={"email": "New@Example.com", "password": PASSWORD})
+    assert b"Verify your e-mail" in response.data
+
+    # unverified users can't log in
+    assert b"Please verify your e-mail" in login(client, "new@example.com").data
+
+    response = client.get("/email-verification/" + code_from(emails))
+    assert b"Registration successfull" in response.data
+    assert User.get_by_id("new@example.com", use_cache=False).is_verified
+
+    assert login(client, "new@example.com").status_code == 302
+    assert is_logged_in(client, "new@example.com")
+
+
+def test_duplicate_registration_is_rejected(client):
+    create_user("user@example.com")
+
+    response = client.post("/registration", data={"email": "USER@example.com", "password": PASSWORD})
+    assert b"already registered" in response.data
+
+
+def test_login_and_logout(client):
+    create_user()
+
+    assert b"wrong e-mail or password" in login(client, password="wrong").data
+    assert not is_logged_in(client)
+
+    assert login(client).status_code == 302
+    assert is_logged_in(client)
+
+    client.post("/logout")
+    assert not is_logged_in(client)
+
+
+def test_sessions_are_separate(app, client):
+    create_user()
+    other_client = app.test_client()
+
+    login(client)
+    login(other_client)
+
+    client.post("/logout")
+
+    assert not is_logged_in(client)
+    assert is_logged_in(other_client)
+
+
+def test_change_password(client, emails):
+    create_user()
+    login(client)
+
+    response = client.get("/change-password")
+    csrf_token = re.search(r'name="csrf_token" value="([^"]+)"', response.get_data(as_text=True)).group(1)
+
+    # a form without the CSRF token is rejected
+    response = client.post("/change-password", data={"current_password": PASSWORD, "new_password": "new-password"})
+    assert not emails
+
+    client.post("/change-password", data={"current_password": PASSWORD, "new_password": "new-password",
+                                          "csrf_token": csrf_token})
+
+    response = client.get("/change-password-confirmation/" + code_from(emails))
+    assert response.status_code == 302
+
+    # all sessions are deleted when the password changes
+    assert not is_logged_in(client)
+    assert login(client, password=PASSWORD).status_code == 200
+    assert login(client, password="new-password").status_code == 302
+
+
+def test_forgot_password(app, client, emails, session_mode):
+    create_user()
+    other_client = app.test_client()
+    login(other_client)
+
+    client.post("/forgot-password", data={"email": "user@example.com"})
+    code = code_from(emails)
+
+    response = client.post("/forgot-password-confirmation/" + code, data={"new_password": "new-password"})
+    assert response.status_code == 302
+
+    # sessions of other browsers are deleted too (a signed claim stays valid until it expires, see SESSION_CLAIMS)
+    assert is_logged_in(other_client) == (session_mode == "claims")
+    assert login(client, password="new-password").status_code == 302
+
+    # the code can't be used again
+    response = client.post("/forgot-password-confirmation/" + code, data={"new_password": "other-password"})
+    assert b"not valid" in response.data
+
+
+def test_login_is_rate_limited(client):
+    create_user()
+
+    for _ in range(10):
+        login(client, password="wrong")
+
+    assert login(client).status_code == 429
+
+
+def test_only_the_newest_forgot_password_link_works(client, emails):
+    create_user()
+
+    client.post("/forgot-password", data={"email": "user@example.com"})
+    first_code = code_from(emails)
+    client.post("/forgot-password", data={"email": "user@example.com"})
+    second_code = code_from(emails)
+
+    response = client.post("/forgot-password-confirmation/" + first_code, data={"new_password": "attacker"})
+    assert b"not valid" in response.data
+
+    client.post("/forgot-password-confirmation/" + second_code, data={"new_password": "new-password"})
+    assert login(client, password="new-password").status_code == 302
+
+
+def test_password_change_invalidates_all_password_links(client, emails):
+    create_user()
+
+    client.post("/forgot-password", data={"email": "user@example.com"})
+    forgot_code = code_from(emails)
+
+    login(client)
+    request_password_change(client, "new-password")
+    client.get("/change-password-confirmation/" + code_from(emails))
+
+    response = client.post("/forgot-password-confirmation/" + forgot_code, data={"new_password": "attacker"})
+    assert b"not valid" in response.data
+    assert login(client, password="new-password").status_code == 302
+
+
+def test_older_change_password_link_is_not_valid(client, emails):
+    create_user()
+    login(client)
+
+    codes = []
+    for new_password in ("first-password", "second-password"):
+        request_password_change(client, new_password)
+        codes.append(code_from(emails))
+
+    assert client.get("/change-password-confirmation/" + codes[1]).status_code == 302
+
+    response = client.get("/change-password-confirmation/" + codes[0])
+    assert response.status_code == 200 and b"not valid" in response.data
+    assert login(client, password="second-password").status_code == 302
+
+
+def test_users_registered_before_email_keys(client):
+    # stored by an older version of the app: with an automatic ID and the e-mail as it was entered
+    legacy_user = User(email="Old@Example.com", password=hash_password(PASSWORD), verified=True)
+    legacy_user.put()
+
+    response = client.post("/registration", data={"email": "Old@Example.com", "password": PASSWORD})
+    assert b"already registered" in response.data
+    assert User.query().count() == 1
+
+    assert login(client, "Old@Example.com").status_code == 302
+
+
+def test_password_flows_write_once(client, emails, commits):
+    create_user()
+    login(client)
+
+    # the code, the new password and the deleted codes and sessions are written at the end of each request
+    for submit in (lambda: request_password_change(client, "new-password"),
+                   lambda: client.get("/change-password-confirmation/" + code_from(emails)),
+                   lambda: client.post("/forgot-password", data={"email": "user@example.com"}),
+                   lambda: client.post("/forgot-password-confirmation/" + code_from(emails),
+                                       data={"new_password": "other-password"})):
+        commits.clear()
+        submit()
+        assert len(commits) == 1
+
+    assert login(client, password="other-password").status_code == 302
+
+
+def test_legacy_email_lookup_can_be_turned_off(client, monkeypatch):
+    monkeypatch.setattr(models.user, "LEGACY_EMAIL_LOOKUP", False)
+
+    user_queries = []
+    run_query = get_stub().run_query
+    function = run_query.function
+
+    def counted_run_query(request):
+        user_queries.extend(kind.name for kind in request.query.kind if kind.name == "User")
+        return function(request)
+
+    monkeypatch.setattr(run_query, "function", counted_run_query)
+
+    response = client.post("/registration", data={"email": "New.User@Example.com ", "password": PASSWORD})
+    assert b"Verify your e-mail" in response.data
+    assert not user_queries  # an unknown e-mail is only looked up by key
+
+
+@pytest.mark.parametrize("key_options", [{"project": "other-project"}, {"namespace": "other-namespace"}])
+def test_session_token_with_a_foreign_user_key(client, monkeypatch, key_options):
+    monkeypatch.setattr(models.user, "SESSION_STORAGE", "entity")
+    create_user()
+
+    user_key = ndb.Key(User, "user@example.com", **key_options)
+    client.set_cookie(models.user.SESSION_COOKIE, user_key.urlsafe().decode() + ".token")
+
+    # not logged in (instead of an error, the Datastore rejects keys of other projects)
+    response = client.get("/admin/users")
+    assert response.status_code == 200 and b"does not exist" in response.data
@@ -0,0 +1,137 @@
+import datetime
+import json
+
+import pytest
+
+from cron import remove_expired_sessions, remove_unverified_users
+from models.one_time_code import OneTimeCode
+from models.user import Session, User
+from tests.conftest import create_user
+
+
+# a verification code of the user that expired an hour ago
+def expired_verification_code(user):
+    OneTimeCode(id=OneTimeCode.hash_code(user.email), purpose=OneTimeCode.VERIFICATION, user_key=user.key,
+                expired=datetime.datetime.now() - datetime.timedelta(hours=1)).put()
+
+
+def user_exists(email):
+    return User.get_by_id(email, use_cache=False, use_global_cache=False) is not None
+
+
+@pytest.fixture
+def enqueued(monkeypatch):
+    """Tasks enqueued by the crons (to continue where they stopped), as (path, payload) pairs."""
+    tasks = []
+    for cron in (remove_unverified_users, remove_expired_sessions):
+        monkeypatch.setattr(cron, "run_background_task",
+                            lambda relative_path, payload, **kwargs: tasks.append((relative_path, payload)))
+    return tasks
+
+
+# runs the tasks enqueued by a cron (and the tasks they enqueue) and returns how many ran
+def run_enqueued(client, enqueued):
+    runs = 0
+
+    while enqueued:
+        path, payload = enqueued.pop()
+        response = client.post(path, data=json.dumps(payload), headers={"X-AppEngine-QueueName": "default"})
+        assert response.status_code == 200
+        runs += 1
+
+    return runs
+
+
+# a session that expires in the given number of days (expired if it's negative)
+def session(token_hash, days, user=None):
+    expired = datetime.datetime.now() + datetime.timedelta(days=days)
+
+    if user:  # stored as a Session entity
+        return Session(id=token_hash, parent=user.key, token_hash=token_hash, expired=expired)
+
+    return Session(token_hash=token_hash, ip="127.0.0.1", expired=expired)
+
+
+def test_remove_unverified_users_in_batches():
+    unverified = [create_user("unverified{0}@example.com".format(number), verified=False) for number in range(5)]
+    verified = create_user("verified@example.com")
+    pending = create_user("pending@example.com", verified=False)  # its code hasn't expired yet
+
+    for user in unverified + [verified]:
+        expired_verification_code(user)
+    OneTimeCode.create(pending, OneTimeCode.VERIFICATION)
+
+    # the time budget runs out after the first batch (of 2 codes, one of them may be the verified user's)
+    deleted, cursor, more = User.remove_unverified_users(batch_size=2, time_budget=0.000001)
+    assert deleted in (1, 2) and cursor and more
+    assert sum(user_exists(user.email) for user in unverified) == 5 - deleted
+
+    # the next run continues from the cursor and finishes the job
+    deleted_later, cursor, more = User.remove_unverified_users(cursor=cursor, batch_size=2)
+    assert deleted + deleted_later == 5 and cursor is None and not more
+
+    assert not any(user_exists(user.email) for user in unverified)
+    assert user_exists("verified@example.com") and user_exists("pending@example.com")
+
+    # expired codes are deleted with their users (also the code of the verified user), the valid code is kept
+    assert OneTimeCode.query().count() == 1
+
+
+def test_remove_unverified_users_cron_continues_in_a_task(client, monkeypatch, enqueued):
+    for number in range(3):
+        expired_verification_code(create_user("unverified{0}@example.com".format(number), verified=False))
+
+    remove_unverified_users_batches = User.remove_unverified_users
+    monkeypatch.setattr(User, "remove_unverified_users",
+                        lambda **kwargs: remove_unverified_users_batches(batch_size=2, **kwargs))
+    monkeypatch.setattr(remove_unverified_users, "TIME_BUDGET", 0.000001)
+
+    response = client.get("/cron/remove_unverified_users_cron")
+    assert response.get_data(as_text=True) == "Removed 2 unverified users"
+    assert len(enqueued) == 1
+
+    assert run_enqueued(client, enqueued) == 1
+    assert User.query().count() == 0
+
+
+def test_remove_expired_sessions():
+    user = create_user()
+    user.sessions = [session("valid", 1), session("expired", -1)]
+    user.put()
+
+    other_user = create_user("other@example.com")
+    other_user.sessions = [session("other", 1)]
+    other_user.put()
+
+    session("valid-entity", 1, user=user).put()
+    session("expired-entity", -1, user=user).put()
+
+    compacted, reclaimed, deleted, cursor, more = User.remove_expired_sessions()
+    assert (compacted, deleted, cursor, more) == (1, 1, None, False)
+    assert reclaimed > 0
+
+    stored_sessions = {email: [item.token_hash for item in User.get_by_id(email, use_cache=False,
+                                                                          use_global_cache=False).sessions]
+                       for email in ("user@example.com", "other@example.com")}
+    assert stored_sessions == {"user@example.com": ["valid"], "other@example.com": ["other"]}
+    assert [key.id() for key in Session.query().fetch(keys_only=True)] == ["valid-entity"]
+
+
+def test_remove_expired_sessions_cron_continues_in_tasks(client, monkeypatch, enqueued):
+    for number in range(3):
+        user = create_user("user{0}@example.com".format(number))
+        user.sessions = [session("expired{0}".format(number), -1)]
+        user.put()
+        session("expired-entity{0}".format(number), -1, user=user).put()
+
+    remove_expired_sessions_batches = User.remove_expired_sessions
+    monkeypatch.setattr(User, "remove_expired_sessions",
+                        lambda **kwargs: remove_expired_sessions_batches(batch_size=2, **kwargs))
+    monkeypatch.setattr(remove_expired_sessions, "TIME_BUDGET", 0.000001)
+
+    # the first run only deletes 2 Session entities, the next ones delete the last one and compact 2 users each
+    assert client.get("/cron/remove_expired_sessions_cron").status_code == 200
+    assert run_enqueued(client, enqueued) == 2
+
+    assert Session.query().count() == 0
+    assert not any(user.sessions for user in User.query().fetch(use_cache=False, use_global_cache=False))
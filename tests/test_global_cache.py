@@ -0,0 +1,36 @@
+from google.cloud import ndb
+
+from models.global_cache import InMemoryGlobalCache, get_global_cache
+from models.memory_datastore import get_stub
+from models.user import User
+from tests.conftest import create_user
+
+
+class CachedItem(ndb.Model):
+    name = ndb.StringProperty()
+
+
+# changes an entity directly in the Datastore, like another instance would (this instance's caches don't know)
+def change_stored(kind, name, property_name, value):
+    entity, _ = get_stub()._entities[kind][("", ((kind, 1, name),))]
+    entity.properties[property_name].string_value = value
+
+
+def test_users_are_not_kept_in_the_in_memory_global_cache():
+    assert isinstance(get_global_cache(), InMemoryGlobalCache)
+
+    create_user()
+    User.get_by_id("user@example.com", use_cache=False)
+
+    change_stored("User", "user@example.com", "email", "changed@example.com")
+
+    assert User.get_by_id("user@example.com", use_cache=False).email == "changed@example.com"
+
+
+def test_other_kinds_are_kept_in_the_in_memory_global_cache():
+    CachedItem(id="item", name="name").put()
+    CachedItem.get_by_id("item", use_cache=False)
+
+    change_stored("CachedItem", "item", "name", "changed")
+
+    assert CachedItem.get_by_id("item", use_cache=False).name == "name"
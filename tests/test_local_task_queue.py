@@ -0,0 +1,76 @@
+import pytest
+from flask import Flask, request
+
+from utils import local_task_queue
+from utils.local_task_queue import LocalQueue, load_queue_config, parse_rate
+
+
+@pytest.fixture
+def task_app():
+    """An app with a task that always fails, it records the retry count of every attempt."""
+    app = Flask(__name__)
+    app.attempts = []
+
+    @app.route("/failing-task", methods=["POST"])
+    def failing_task():
+        app.attempts.append(int(request.headers["X-AppEngine-TaskRetryCount"]))
+        return "error", 500
+
+    return app
+
+
+def test_parse_rate():
+    assert parse_rate("5/s") == 5
+    assert parse_rate("100/m") == pytest.approx(100 / 60)
+    assert parse_rate("36/h") == pytest.approx(0.01)
+    assert parse_rate("2") == 2
+
+
+def test_backoff_doubles_up_to_max_doublings(task_app):
+    queue = LocalQueue(task_app, "backoff", min_backoff_seconds=1, max_backoff_seconds=30, max_doublings=3,
+                       max_concurrent_requests=0)
+
+    # doubled 3 times, then it grows by 8 seconds (the last doubled delay) per retry, up to max_backoff_seconds
+    assert [queue.backoff(retry_count) for retry_count in range(7)] == [1, 2, 4, 8, 16, 24, 30]
+
+
+def test_token_bucket(task_app):
+    queue = LocalQueue(task_app, "rate", rate=2, bucket_size=2, max_concurrent_requests=0)
+    now = queue._tokens_updated
+
+    # a burst of bucket_size tasks, then one task every 1 / rate seconds
+    assert [queue._take_token(now) for _ in range(3)] == [0, 0, 0.5]
+    assert queue._take_token(now + 0.5) == 0
+    assert queue._take_token(now + 0.5) == 0.5
+
+
+def test_failing_task_is_retried_until_the_retry_limit(task_app):
+    queue = LocalQueue(task_app, "retries", rate=1000, bucket_size=100, task_retry_limit=2,
+                       min_backoff_seconds=0.001, max_backoff_seconds=0.01)
+
+    queue.add("/failing-task", b"{}")
+
+    assert queue.join(timeout=5)
+    assert task_app.attempts == [0, 1, 2]
+    assert queue.stats() == {"pending": 0, "executed": 0, "retried": 2, "failed": 1}
+
+
+def test_load_queue_config(tmp_path):
+    path = tmp_path / "queue.yaml"
+    path.write_text("""
+queue:
+- name: email
+  rate: 100/m
+  bucket_size: 10
+  retry_parameters:
+    task_retry_limit: 3
+    min_backoff_seconds: 30
+    max_doublings: 4
+""")
+
+    assert load_queue_config(str(path)) == {"email": {"rate": pytest.approx(100 / 60), "bucket_size": 10,
+                                                      "task_retry_limit": 3, "min_backoff_seconds": 30.0,
+                                                      "max_doublings": 4}}
+
+    # the queues of the app
+    assert set(load_queue_config(local_task_queue.QUEUE_YAML)) == {"default", "email"}
@@ -0,0 +1,116 @@
+import datetime
+
+import pytest
+from google.api_core import exceptions as core_exceptions
+from google.cloud import ndb
+from google.cloud.datastore_v1.types import datastore as datastore_pb2
+from google.cloud.datastore_v1.types import entity as entity_pb2
+
+from models.memory_datastore import InMemoryDatastoreStub
+
+
+class Item(ndb.Model):
+    number = ndb.IntegerProperty()
+    group = ndb.StringProperty()
+    tags = ndb.StringProperty(repeated=True)
+    created = ndb.DateTimeProperty()
+    note = ndb.TextProperty()
+
+
+@pytest.fixture
+def items():
+    return ndb.put_multi([Item(number=number, group="group-{0}".format(number % 3), tags=["all", str(number)],
+                               created=datetime.datetime(2020, 1, 1) + datetime.timedelta(days=number), note="note")
+                          for number in range(10)])
+
+
+def test_put_and_get(items):
+    assert items[0].id() != items[1].id()  # incomplete keys get ids
+
+    Item(id="named", number=100).put()
+
+    assert Item.get_by_id("named", use_cache=False).number == 100
+    assert items[3].get(use_cache=False).tags == ["all", "3"]
+    assert Item.get_by_id("missing") is None
+
+
+def test_filters_and_orders(items):
+    assert [item.number for item in Item.query(Item.number >= 3, Item.number < 6).order(-Item.number)] == [5, 4, 3]
+    assert Item.query(Item.group == "group-1").count() == 3
+    assert Item.query(Item.tags == "4").get().number == 4  # any value of a repeated property
+    assert [item.number for item in Item.query(ndb.OR(Item.number == 1, Item.number == 8)).order(Item.number)] == \
+        [1, 8]
+    assert Item.query(Item.number.IN([2, 5, 20])).count() == 2
+    assert Item.query(Item.number != 2).count() == 9
+    assert Item.query(Item.created < datetime.datetime(2020, 1, 3)).count() == 2
+
+
+def test_unindexed_properties_are_not_queryable(items):
+    assert Item.query(ndb.GenericProperty("note") == "note").count() == 0
+
+
+def test_keys_only_projection_and_distinct(items):
+    assert Item.query().order(Item.number).fetch(3, keys_only=True, offset=2) == items[2:5]
+    assert [item.group for item in Item.query(projection=[Item.group], distinct=True).order(Item.group)] == \
+        ["group-0", "group-1", "group-2"]
+
+
+def test_cursors(items):
+    query = Item.query().order(Item.number)
+
+    page, cursor, more = query.fetch_page(4)
+    assert [item.number for item in page] == [0, 1, 2, 3] and more
+
+    page, cursor, more = query.fetch_page(4, start_cursor=cursor)
+    assert [item.number for item in page] == [4, 5, 6, 7] and more
+
+    page, cursor, more = query.fetch_page(4, start_cursor=cursor)
+    assert [item.number for item in page] == [8, 9] and not more
+
+    # a cursor resumes right after its entity
+    iterator = query.iter()
+    assert iterator.has_next() and iterator.next().number == 0
+    assert [item.number for item in query.fetch(2, start_cursor=iterator.cursor_after())] == [1, 2]
+
+
+def test_ancestor_queries():
+    parent = ndb.Key("Item", "parent")
+    Item(parent=parent, number=1).put()
+    Item(number=2).put()
+
+    assert [item.number for item in Item.query(ancestor=parent)] == [1]
+
+
+def test_transactions(items):
+    @ndb.transactional()
+    def increment():
+        item = items[0].get()
+        item.number += 10
+        item.put()
+
+    increment()
+
+    assert items[0].get(use_cache=False).number == 10
+
+
+def test_conflicting_transaction_is_aborted():
+    stub = InMemoryDatastoreStub()
+    key = entity_pb2.Key(partition_id=entity_pb2.PartitionId(project_id="test"),
+                         path=[entity_pb2.Key.PathElement(kind="Item", name="item")])
+
+    def upsert(transaction=b""):
+        return stub.commit(datastore_pb2.CommitRequest(
+            project_id="test", transaction=transaction,
+            mode=datastore_pb2.CommitRequest.Mode.TRANSACTIONAL if transaction else
+            datastore_pb2.CommitRequest.Mode.NON_TRANSACTIONAL,
+            mutations=[datastore_pb2.Mutation(upsert=entity_pb2.Entity(key=key))]))
+
+    upsert()
+    transaction = stub.begin_transaction(datastore_pb2.BeginTransactionRequest(project_id="test")).transaction
+    stub.lookup(datastore_pb2.LookupRequest(project_id="test", keys=[key],
+                                            read_options=datastore_pb2.ReadOptions(transaction=transaction)))
+
+    upsert()  # somebody else changes the entity meanwhile
+
+    with pytest.raises(core_exceptions.Aborted):
+        upsert(transaction)
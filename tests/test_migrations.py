@@ -0,0 +1,51 @@
+from google.cloud import ndb
+
+from models.memory_datastore import get_stub
+from models.user import User
+from tasks.migrate_users_task import MIGRATIONS
+from tests.conftest import create_user
+
+
+# the stored User entity, as the Datastore has it
+def stored_user(email="user@example.com"):
+    entity, _ = get_stub()._entities["User"][("", (("User", 1, email),))]
+    return entity
+
+
+def run_migration(client, name):
+    response = client.post("/tasks/migrate-users/" + name)
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def test_csrf_tokens_migration_removes_stored_tokens(client):
+    create_user()
+    create_user("other@example.com")
+
+    # a CSRF token stored by an older version of the app
+    legacy_value = stored_user().properties["csrf_tokens.expired"]
+    legacy_value.array_value.values.add().timestamp_value.seconds = 1000
+
+    assert run_migration(client, "csrf-tokens") == "Migrated 2 items"
+    assert "csrf_tokens.expired" not in stored_user().properties
+    assert User.get_by_id("user@example.com", use_cache=False, use_global_cache=False).email == "user@example.com"
+
+
+def test_all_migrations_run(client):
+    create_user()
+
+    for name in MIGRATIONS:
+        run_migration(client, name)
+
+    assert ndb.Key(User, "user@example.com").get(use_cache=False, use_global_cache=False)
+
+
+def test_migrations_run_in_batches():
+    for number in range(3):
+        create_user("user{0}@example.com".format(number))
+
+    migrated, cursor, more = User.migrate_index_policy(batch_size=2)
+    assert migrated == 2 and cursor and more
+
+    migrated, cursor, more = User.migrate_index_policy(cursor=cursor, batch_size=2)
+    assert migrated == 1 and not more
@@ -0,0 +1,41 @@
+import bcrypt
+import pytest
+
+from utils import password_policy
+
+
+def bcrypt_hash(rounds):
+    return bcrypt.hashpw(b"password", bcrypt.gensalt(rounds=rounds)).decode()
+
+
+@pytest.fixture
+def rounds(monkeypatch):
+    def set_rounds(value):
+        monkeypatch.setattr(password_policy, "_rounds", value)
+
+    return set_rounds
+
+
+def test_needs_rehash_only_with_a_higher_cost(rounds):
+    rounds(5)
+
+    assert password_policy.needs_rehash(bcrypt_hash(4))
+    assert not password_policy.needs_rehash(bcrypt_hash(5))
+    assert not password_policy.needs_rehash(bcrypt_hash(6))  # never re-hashed with a lower cost
+
+
+def test_calibration_never_goes_below_the_default(rounds, monkeypatch):
+    rounds(None)
+    monkeypatch.delenv("BCRYPT_ROUNDS")
+    monkeypatch.setenv("BCRYPT_TARGET_MS", "250")
+    monkeypatch.setattr(password_policy, "measure", lambda cost, tries=3: 10.0)  # a very slow instance
+
+    assert password_policy.get_rounds() == password_policy.DEFAULT_ROUNDS
+
+
+def test_bcrypt_rounds_setting(rounds, monkeypatch):
+    rounds(None)
+    monkeypatch.setenv("BCRYPT_ROUNDS", "13")
+    monkeypatch.setenv("BCRYPT_TARGET_MS", "250")
+
+    assert password_policy.get_rounds() == 13
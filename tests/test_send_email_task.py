@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from tasks import send_email_task
+
+
+class FakeSender(object):
+    """Fails to send the e-mails of the recipients in failing."""
+
+    def __init__(self, failing):
+        self.failing = failing
+
+    def send(self, messages):
+        return [{"recipient_email": message["recipient_email"],
+                 "success": message["recipient_email"] not in self.failing, "error": None} for message in messages]
+
+
+@pytest.fixture
+def enqueued(monkeypatch):
+    """Payloads of the tasks enqueued by the send-email task."""
+    payloads = []
+    monkeypatch.setattr(send_email_task, "is_local", lambda: False)
+    monkeypatch.setattr(send_email_task, "run_background_task", lambda **kwargs: payloads.append(kwargs["payload"]))
+    return payloads
+
+
+def send(client, monkeypatch, recipients, failing):
+    monkeypatch.setattr(send_email_task, "get_sender", lambda: FakeSender(failing))
+
+    messages = [{"recipient_email": recipient, "sender_email": "info@example.com", "email_subject": "Subject",
+                 "email_body": "<p>Body</p>", "non_html_message": "Body"} for recipient in recipients]
+
+    return client.post("/tasks/send-email", data=json.dumps({"messages": messages}),
+                       headers={"X-AppEngine-QueueName": "email"})
+
+
+def test_failed_messages_are_sent_again_in_a_new_task(client, monkeypatch, enqueued):
+    response = send(client, monkeypatch, ["a@example.com", "b@example.com", "c@example.com"], failing={"b@example.com"})
+
+    assert response.status_code == 200
+    assert [[message["recipient_email"] for message in payload["messages"]] for payload in enqueued] == \
+        [["b@example.com"]]
+
+
+def test_task_is_retried_when_nothing_was_sent(client, monkeypatch, enqueued):
+    response = send(client, monkeypatch, ["a@example.com", "b@example.com"], failing={"a@example.com", "b@example.com"})
+
+    assert response.status_code == 500
+    assert not enqueued
+
+
+def test_nothing_is_enqueued_when_everything_was_sent(client, monkeypatch, enqueued):
+    assert send(client, monkeypatch, ["a@example.com"], failing=set()).status_code == 200
+    assert not enqueued
@@ -0,0 +1,55 @@
+import pytest
+
+import models.user
+from models import unit_of_work
+from models.user import User
+from tests.conftest import create_user, is_logged_in, login
+
+
+@pytest.fixture(autouse=True, params=["embedded", "entity"])
+def expired_claims(request, monkeypatch):
+    """Signed session claims that have always expired, so every request checks the session and refreshes the claim."""
+    monkeypatch.setattr(models.user, "SESSION_STORAGE", request.param)
+    monkeypatch.setattr(models.user, "SESSION_CLAIMS", True)
+    monkeypatch.setattr(models.user, "SESSION_CLAIM_SECONDS", -10)
+
+
+def session_cookies(response):
+    return [header for header in response.headers.getlist("Set-Cookie")
+            if header.startswith(models.user.SESSION_COOKIE + "=")]
+
+
+def test_claim_is_refreshed(client):
+    create_user()
+    login(client)
+
+    response = client.get("/admin/users")
+
+    assert len(session_cookies(response)) == 1
+    assert is_logged_in(client)
+
+
+def test_logout_does_not_refresh_the_claim(client):
+    create_user()
+    login(client)
+
+    response = client.post("/logout")
+
+    assert len(session_cookies(response)) == 1  # only the cookie that removes the session
+    assert not is_logged_in(client)
+
+
+def test_deleting_all_sessions_cancels_the_claim(app):
+    user = create_user()
+
+    with app.test_request_context("/", environ_base={"REMOTE_ADDR": "127.0.0.1"}):
+        cookie = User.generate_session(user)
+        unit_of_work.flush()
+
+    with app.test_request_context("/"):
+        assert User.verify_session(cookie)[0]
+
+        User.delete_all_user_sessions(user)
+        unit_of_work.flush()
+
+        assert not session_cookies(User._refresh_session_claim(app.response_class()))
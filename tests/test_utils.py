@@ -0,0 +1,56 @@
+import pytest
+from google.cloud import ndb
+
+from models import unit_of_work
+from models.user import User
+from utils import rate_limit, signing
+
+
+def test_signing():
+    signed = signing.sign("value", purpose="test")
+
+    assert signing.unsign(signed, purpose="test") == "value"
+    assert signing.unsign(signed, purpose="other") is None
+    assert signing.unsign(signed.replace("value", "other"), purpose="test") is None
+    assert signing.unsign("", purpose="test") is None
+
+
+def test_memory_rate_limit_store():
+    store = rate_limit.MemoryStore()
+
+    assert [store.take("key", 2, 1)[0] for _ in range(3)] == [True, True, False]
+    assert store.take("other key", 2, 1)[0]
+
+
+def test_rate_limit_check(monkeypatch):
+    monkeypatch.setitem(rate_limit.LIMITS, "login", {"ip": (1, 60)})
+
+    rate_limit.check("login", ip="127.0.0.1")
+
+    with pytest.raises(rate_limit.RateLimited):
+        rate_limit.check("login", ip="127.0.0.1")
+
+
+def test_unit_of_work_writes_at_flush(app):
+    key = ndb.Key(User, "user@example.com")
+
+    with app.test_request_context("/"):
+        user = User(key=key, email="user@example.com")
+        unit_of_work.save(user)
+        unit_of_work.save(user)
+
+        flushed = []
+        unit_of_work.on_flush(lambda: flushed.append(True))
+
+        assert key.get(use_cache=False, use_global_cache=False) is None
+
+        unit_of_work.flush()
+
+    assert key.get(use_cache=False, use_global_cache=False).email == "user@example.com"
+    assert flushed == [True]
+
+
+def test_unit_of_work_writes_right_away_outside_requests():
+    unit_of_work.save(User(id="user@example.com", email="user@example.com"))
+
+    assert User.get_by_id("user@example.com", use_cache=False, use_global_cache=False)
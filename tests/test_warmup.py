@@ -0,0 +1,13 @@
+import sys
+
+from utils import task_helper
+
+
+def test_warmup_loads_deferred_modules(client, monkeypatch):
+    monkeypatch.delitem(sys.modules, "bleach")
+    monkeypatch.setattr(task_helper, "_client", None)
+
+    assert client.get("/_ah/warmup").status_code == 200
+
+    assert "bleach" in sys.modules
+    assert task_helper._client is None  # locally (no PROD_ENV setting) Cloud Tasks is not used
@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A thread-safe in-process cache bounded by size (least recently used entries are evicted first) and by TTL."""
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl  # in seconds
+
+        # hit/miss counters (useful to check if the cache is worth it)
+        self.hits = 0
+        self.misses = 0
+
+        self._items = OrderedDict()  # key: (value, expiration timestamp)
+        self._lock = threading.Lock()
+
+    # returns the cached value or None if the key is not cached (or the entry has expired)
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+
+            if item is not None:
+                value, expires = item
+
+                if expires > time.monotonic():
+                    self._items.move_to_end(key)  # mark as recently used
+                    self.hits += 1
+                    return value
+
+                del self._items[key]  # expired
+
+            self.misses += 1
+            return None
+
+    # stores a value, optionally with a shorter TTL than the default one
+    def set(self, key, value, ttl=None):
+        if ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + ttl)
+            self._items.move_to_end(key)
+
+            # remove the least recently used entries if the cache is full
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    # removes a single entry
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    # removes all entries for which predicate(key, value) is True
+    def delete_where(self, predicate):
+        with self._lock:
+            for key in [key for key, (value, expires) in self._items.items() if predicate(key, value)]:
+                del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._items), "max_size": self.max_size}
@@ -1,26 +1,50 @@
 import os
 from models.settings import Settings
-from flask import request, render_template, url_for
-from utils.task_helper import run_background_task
+from flask import request, url_for
+from utils.task_helper import run_background_task, run_background_tasks
 
 
-def send_email(recipient_email, email_template, email_params, email_subject, non_html_message, sender_email=None):
+# max. number of e-mails sent by one background task (see send_emails)
+MESSAGES_PER_TASK = 100
+
+
+# prepares the params sent to the background task
+def _prepare_message(recipient_email, email_template, email_params, email_subject, non_html_message,
+                     sender_email=None):
     if not sender_email:
-        if Settings.get_by_name("APP_EMAIL"):
-            sender_email = Settings.get_by_name("APP_EMAIL").value  # reads from settings
+        app_email = Settings.get_by_name("APP_EMAIL")
+
+        if app_email:
+            sender_email = app_email.value  # reads from settings
         else:
             sender_email = "info@your.webapp"
 
     # send web app URL data by default to email template
     email_params["app_root_url"] = request.url_root
 
-    # render the email HTML body
-    email_body = render_template(email_template, **email_params)
+    # the email HTML body is rendered by the background task (see utils/email_renderer.py), so only the template
+    # name and its params are sent
+    return {"recipient_email": recipient_email, "email_subject": email_subject, "sender_email": sender_email,
+            "email_template": email_template, "email_params": email_params, "non_html_message": non_html_message}
+
 
-    # params sent to the background task
-    payload = {"recipient_email": recipient_email, "email_subject": email_subject, "sender_email": sender_email,
-               "email_body": email_body, "non_html_message": non_html_message}
+def send_email(recipient_email, email_template, email_params, email_subject, non_html_message, sender_email=None):
+    payload = _prepare_message(recipient_email=recipient_email, email_template=email_template,
+                               email_params=email_params, email_subject=email_subject,
+                               non_html_message=non_html_message, sender_email=sender_email)
 
     run_background_task(relative_path=url_for("tasks.send_email_task.send_email_via_sendgrid"),
                         payload=payload, queue="email", project=os.environ.get("GOOGLE_CLOUD_PROJECT"),
                         location="europe-west1")
+
+
+# sends many e-mails (each one a dict with send_email arguments) with as few background tasks as possible
+def send_emails(emails):
+    messages = [_prepare_message(**email) for email in emails]
+
+    payloads = [{"messages": messages[start:start + MESSAGES_PER_TASK]}
+                for start in range(0, len(messages), MESSAGES_PER_TASK)]
+
+    run_background_tasks(relative_path=url_for("tasks.send_email_task.send_email_via_sendgrid"),
+                         payloads=payloads, queue="email", project=os.environ.get("GOOGLE_CLOUD_PROJECT"),
+                         location="europe-west1")
@@ -0,0 +1,82 @@
+import os
+import threading
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+
+# templates folder in the root of the app
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates")
+
+# the layout that all e-mail templates extend
+EMAIL_LAYOUT = "emails/base.html"
+
+# marks the place of a block in the rendered layout (can't appear in a template)
+_BLOCK_MARKER = "\x00{0}\x00"
+
+
+class EmailRenderer(object):
+    """Renders e-mail templates in background tasks (instead of in the request that sends the e-mail).
+
+    All e-mail templates are compiled once. The layout is rendered only once per app URL (its only variable) and
+    split on the blocks, so rendering an e-mail only renders the blocks of its template and joins them with the
+    already rendered parts of the layout.
+    """
+
+    def __init__(self, templates_dir=TEMPLATES_DIR, layout=EMAIL_LAYOUT):
+        self.environment = Environment(loader=FileSystemLoader(templates_dir), autoescape=select_autoescape(["html"]),
+                                       cache_size=-1, auto_reload=False)
+        self.layout = self.environment.get_template(layout)
+
+        self._layout_parts = {}  # app URL: list of rendered layout parts and block names
+        self._lock = threading.Lock()
+
+    # compiles all e-mail templates
+    def precompile(self):
+        for name in self.environment.list_templates(filter_func=lambda name: name.startswith("emails/")):
+            self.environment.get_template(name)
+
+    # renders the layout with markers instead of blocks and splits it into parts: [text, block name, text, ...]
+    def _get_layout_parts(self, app_root_url):
+        with self._lock:
+            if app_root_url not in self._layout_parts:
+                source = "{% extends layout %}" + "".join(
+                    "{% block " + name + " %}" + _BLOCK_MARKER.format(name) + "{% endblock %}"
+                    for name in self.layout.blocks)
+
+                rendered = self.environment.from_string(source).render(layout=self.layout,
+                                                                       app_root_url=app_root_url)
+
+                self._layout_parts[app_root_url] = rendered.split("\x00")
+
+            return self._layout_parts[app_root_url]
+
+    def render(self, email_template, **email_params):
+        template = self.environment.get_template(email_template)
+        context = template.new_context(email_params)
+
+        parts = []
+        for index, part in enumerate(self._get_layout_parts(email_params.get("app_root_url"))):
+            if index % 2 == 0:
+                parts.append(part)  # already rendered part of the layout
+            else:
+                # the block of the e-mail template (or of the layout, if the e-mail template doesn't have it)
+                block = template.blocks.get(part) or self.layout.blocks[part]
+                parts.append("".join(block(context)))
+
+        return "".join(parts)
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+# returns the renderer shared by the whole instance
+def get_renderer():
+    global _renderer
+
+    with _renderer_lock:
+        if _renderer is None:
+            _renderer = EmailRenderer()
+            _renderer.precompile()
+
+    return _renderer
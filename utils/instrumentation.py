@@ -0,0 +1,125 @@
+import contextlib
+import threading
+import time
+
+from flask import g, has_request_context, request, before_render_template, template_rendered
+
+from utils import metrics
+
+
+# Times the phases of every request (Datastore RPCs, password hashing, template rendering, enqueueing background
+# tasks), sends them to the browser in the Server-Timing header and aggregates them per endpoint for /metrics.
+# Everything is wired up in main.py.
+
+PHASES = ("datastore", "bcrypt", "render", "tasks")
+
+request_time = metrics.histogram("http_request_duration_seconds", "Request duration by endpoint.")
+phase_time = metrics.histogram("http_request_phase_seconds", "Time spent in a phase of a request by endpoint.")
+datastore_rpcs = metrics.counter("datastore_rpcs_total", "Datastore RPCs by endpoint and RPC.")
+
+_hooks_lock = threading.Lock()
+_hooks_installed = False
+
+
+def _timings():
+    if not has_request_context():
+        return None
+
+    if "timings" not in g:
+        g.timings = {}
+
+    return g.timings
+
+
+# adds the duration (in seconds) to a phase of the current request
+def record(phase, seconds):
+    timings = _timings()
+
+    if timings is not None:
+        total, count = timings.get(phase, (0.0, 0))
+        timings[phase] = (total + seconds, count + 1)
+
+
+@contextlib.contextmanager
+def timed(phase):
+    started = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - started)
+
+
+# before_request handler
+def start_request():
+    g.request_started = time.perf_counter()
+
+
+# after_request handler
+def finish_request(response):
+    if "request_started" not in g:
+        return response
+
+    duration = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or "unknown"
+    timings = _timings()
+
+    request_time.observe(duration, endpoint=endpoint)
+
+    server_timing = []
+    for phase in PHASES:
+        if phase in timings:
+            total, count = timings[phase]
+            phase_time.observe(total, endpoint=endpoint, phase=phase)
+            server_timing.append("{0};dur={1:.1f};desc=\"{2}x\"".format(phase, total * 1000, count))
+
+    server_timing.append("total;dur={0:.1f}".format(duration * 1000))
+    response.headers["Server-Timing"] = ", ".join(server_timing)
+
+    return response
+
+
+def _count_rpc(rpc_name):
+    if has_request_context():
+        datastore_rpcs.inc(endpoint=request.endpoint or "unknown", rpc=rpc_name)
+
+
+# times every Datastore RPC made by ndb (ndb has no hooks for this, so its make_call function is wrapped)
+def install_datastore_hooks():
+    global _hooks_installed
+
+    from google.cloud.ndb import _datastore_api
+
+    with _hooks_lock:
+        if _hooks_installed:
+            return
+
+        make_call = _datastore_api.make_call
+
+        def timed_make_call(rpc_name, *args, **kwargs):
+            started = time.perf_counter()
+            _count_rpc(rpc_name)
+
+            future = make_call(rpc_name, *args, **kwargs)
+            future.add_done_callback(lambda _: record("datastore", time.perf_counter() - started))
+
+            return future
+
+        _datastore_api.make_call = timed_make_call
+        _hooks_installed = True
+
+
+def _template_started(sender, template, context, **extra):
+    if has_request_context():
+        g.setdefault("render_started", []).append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    if has_request_context() and g.get("render_started"):
+        record("render", time.perf_counter() - g.render_started.pop())
+
+
+# times Jinja rendering with Flask's template signals
+def connect_template_signals(app):
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_rendered, app)
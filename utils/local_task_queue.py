@@ -0,0 +1,212 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+
+
+# queue.yaml in the root of the app
+QUEUE_YAML = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "queue.yaml")
+
+# seconds per rate unit in queue.yaml (e.g. "5/s")
+RATE_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+
+class LocalQueue(object):
+    """Runs tasks of one queue on localhost, like Cloud Tasks would (but inside this process).
+
+    Tasks are sent as POST requests to the Flask app (with the X-AppEngine-QueueName header) from worker threads, at
+    most `rate` tasks per second (with bursts up to `bucket_size`). Failed tasks (non-2xx responses or exceptions) are
+    retried with exponential backoff until `task_retry_limit` is reached.
+    """
+
+    def __init__(self, app, name, rate=5.0, bucket_size=5, max_concurrent_requests=4, task_retry_limit=None,
+                 min_backoff_seconds=0.1, max_backoff_seconds=3600, max_doublings=16):
+        self.app = app
+        self.name = name
+        self.rate = rate
+        self.bucket_size = bucket_size
+        self.task_retry_limit = task_retry_limit
+        self.min_backoff_seconds = min_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.max_doublings = max_doublings
+
+        # counters
+        self.executed = 0
+        self.retried = 0
+        self.failed = 0
+
+        self._tasks = []  # heap of (time when the task can run, sequence number, task)
+        self._sequence = itertools.count()
+        self._pending = 0  # tasks waiting or running
+        self._tokens = float(bucket_size)
+        self._tokens_updated = time.monotonic()
+        self._condition = threading.Condition()
+
+        for number in range(max_concurrent_requests):
+            threading.Thread(target=self._worker, name="local-queue-{0}-{1}".format(name, number), daemon=True).start()
+
+    # adds a task to the queue
+    def add(self, relative_path, body):
+        task = {"name": uuid.uuid4().hex, "relative_path": relative_path, "body": body, "retry_count": 0}
+
+        with self._condition:
+            self._pending += 1
+            heapq.heappush(self._tasks, (time.monotonic(), next(self._sequence), task))
+            self._condition.notify_all()
+
+        return task["name"]
+
+    # waits until all tasks are done (returns False if they are not done before the timeout)
+    def join(self, timeout=None):
+        with self._condition:
+            return self._condition.wait_for(lambda: self._pending == 0, timeout=timeout)
+
+    # the delay before the retry (doubled max_doublings times, then it grows linearly, like on Cloud Tasks)
+    def backoff(self, retry_count):
+        if retry_count <= self.max_doublings:
+            delay = self.min_backoff_seconds * 2 ** retry_count
+        else:
+            delay = self.min_backoff_seconds * 2 ** self.max_doublings * (retry_count - self.max_doublings + 1)
+
+        return min(delay, self.max_backoff_seconds)
+
+    # takes a token from the token bucket (returns 0) or returns the number of seconds until the next token
+    def _take_token(self, now):
+        self._tokens = min(self.bucket_size, self._tokens + (now - self._tokens_updated) * self.rate)
+        self._tokens_updated = now
+
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+
+        if not self.rate:
+            return 1  # paused queue
+
+        return (1 - self._tokens) / self.rate
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self._tasks:
+                        self._condition.wait()
+                        continue
+
+                    now = time.monotonic()
+                    eta = self._tasks[0][0]
+
+                    if eta > now:
+                        self._condition.wait(eta - now)
+                        continue
+
+                    wait = self._take_token(now)
+
+                    if wait:
+                        self._condition.wait(wait)
+                        continue
+
+                    task = heapq.heappop(self._tasks)[2]
+                    break
+
+            self._execute(task)
+
+    def _execute(self, task):
+        headers = {"X-AppEngine-QueueName": self.name, "X-AppEngine-TaskName": task["name"],
+                   "X-AppEngine-TaskRetryCount": str(task["retry_count"]),
+                   "Content-type": "application/octet-stream"}
+
+        try:
+            response = self.app.test_client(use_cookies=False).post(task["relative_path"], data=task["body"],
+                                                                    headers=headers)
+            success = 200 <= response.status_code < 300
+        except Exception as e:
+            logging.exception("Task {0} ({1}) raised an error: {2}".format(task["name"], task["relative_path"], e))
+            success = False
+
+        with self._condition:
+            if success:
+                self.executed += 1
+                self._pending -= 1
+            elif self.task_retry_limit is None or task["retry_count"] < self.task_retry_limit:
+                self.retried += 1
+                eta = time.monotonic() + self.backoff(task["retry_count"])
+                task["retry_count"] += 1
+                heapq.heappush(self._tasks, (eta, next(self._sequence), task))
+            else:
+                logging.error("Task {0} ({1}) failed {2} times, giving up.".format(
+                    task["name"], task["relative_path"], task["retry_count"] + 1))
+                self.failed += 1
+                self._pending -= 1
+
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {"pending": self._pending, "executed": self.executed, "retried": self.retried,
+                    "failed": self.failed}
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+# converts a queue.yaml rate (e.g. "5/s" or "100/m") to tasks per second
+def parse_rate(rate):
+    number, _, unit = str(rate).partition("/")
+
+    return float(number) / RATE_UNITS[unit or "s"]
+
+
+# reads queue settings from queue.yaml (queue name: LocalQueue arguments)
+def load_queue_config(path=QUEUE_YAML):
+    import yaml  # only needed on localhost
+
+    with open(path) as queue_file:
+        config = yaml.safe_load(queue_file) or {}
+
+    queues = {}
+    for queue in config.get("queue") or []:
+        settings = {}
+
+        if "rate" in queue:
+            settings["rate"] = parse_rate(queue["rate"])
+
+        for name in ("bucket_size", "max_concurrent_requests"):
+            if name in queue:
+                settings[name] = int(queue[name])
+
+        for name, value in (queue.get("retry_parameters") or {}).items():
+            if name in ("task_retry_limit", "max_doublings"):
+                settings[name] = int(value)
+            elif name in ("min_backoff_seconds", "max_backoff_seconds"):
+                settings[name] = float(value)
+
+        queues[queue["name"]] = settings
+
+    return queues
+
+
+# returns the local queue with this name (queues that are not in queue.yaml get the default settings)
+def get_queue(app, name):
+    with _queues_lock:
+        if name not in _queues:
+            settings = load_queue_config().get(name, {})
+            _queues[name] = LocalQueue(app, name, **settings)
+
+        return _queues[name]
+
+
+# waits until the tasks in all local queues are done
+def join(timeout=None):
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    for queue in list(_queues.values()):
+        remaining = max(deadline - time.monotonic(), 0) if deadline is not None else None
+
+        if not queue.join(timeout=remaining):
+            return False
+
+    return True
@@ -0,0 +1,128 @@
+import bisect
+import threading
+
+
+# default histogram buckets (in seconds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# all metrics of this instance (metric name: metric)
+REGISTRY = {}
+_registry_lock = threading.Lock()
+
+
+class Counter(object):
+    """A value that only goes up (e.g. the number of rejected requests), optionally split by labels."""
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+
+        self._values = {}  # labels (sorted tuple of (name, value) pairs): value
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        labels = tuple(sorted(labels.items()))
+
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class Histogram(object):
+    """Counts observed values (e.g. durations) in buckets, optionally split by labels."""
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+
+        self._series = {}  # labels (sorted tuple of (name, value) pairs): {"buckets": [...], "sum": ..., "count": ...}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        labels = tuple(sorted(labels.items()))
+
+        with self._lock:
+            series = self._series.get(labels)
+
+            if series is None:
+                series = self._series[labels] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+
+            # bucket counts are not cumulative here (only the bucket the value falls in is increased)
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series["buckets"][index] += 1
+
+            series["sum"] += value
+            series["count"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {labels: {"buckets": list(series["buckets"]), "sum": series["sum"], "count": series["count"]}
+                    for labels, series in self._series.items()}
+
+
+# returns the registered metric with this name or registers a new one
+def _get_or_register(metric_class, name, *args, **kwargs):
+    with _registry_lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = metric_class(name, *args, **kwargs)
+
+        return REGISTRY[name]
+
+
+def counter(name, description):
+    return _get_or_register(Counter, name, description)
+
+
+def histogram(name, description, buckets=DEFAULT_BUCKETS):
+    return _get_or_register(Histogram, name, description, buckets=buckets)
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+
+    if not labels:
+        return ""
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    return "{" + ",".join("{0}=\"{1}\"".format(name, escape(value)) for name, value in labels) + "}"
+
+
+# all metrics in the Prometheus text format (see the /metrics endpoint)
+def render_prometheus():
+    lines = []
+
+    with _registry_lock:
+        metrics = sorted(REGISTRY.values(), key=lambda metric: metric.name)
+
+    for metric in metrics:
+        lines.append("# HELP {0} {1}".format(metric.name, metric.description))
+
+        if isinstance(metric, Counter):
+            lines.append("# TYPE {0} counter".format(metric.name))
+
+            for labels, value in sorted(metric.snapshot().items()):
+                lines.append("{0}{1} {2}".format(metric.name, _format_labels(labels), value))
+        else:
+            lines.append("# TYPE {0} histogram".format(metric.name))
+
+            for labels, series in sorted(metric.snapshot().items()):
+                # Prometheus buckets are cumulative
+                cumulative = 0
+                for bound, count in zip(metric.buckets, series["buckets"]):
+                    cumulative += count
+                    lines.append("{0}_bucket{1} {2}".format(metric.name, _format_labels(labels, [("le", bound)]),
+                                                            cumulative))
+
+                lines.append("{0}_bucket{1} {2}".format(metric.name, _format_labels(labels, [("le", "+Inf")]),
+                                                        series["count"]))
+                lines.append("{0}_sum{1} {2}".format(metric.name, _format_labels(labels), series["sum"]))
+                lines.append("{0}_count{1} {2}".format(metric.name, _format_labels(labels), series["count"]))
+
+    return "\n".join(lines) + "\n"
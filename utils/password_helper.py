@@ -0,0 +1,64 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+from werkzeug.exceptions import ServiceUnavailable
+
+from utils import instrumentation, metrics, password_policy
+
+
+# bcrypt takes hundreds of milliseconds of CPU per password, so all hashing runs in a fixed-size thread pool (bcrypt
+# releases the GIL while it works). This caps the CPU used for hashing, so a burst of logins can't starve the other
+# requests. When more than PASSWORD_HASHING_QUEUE_LIMIT passwords are already waiting, new requests fail fast with 503.
+PASSWORD_HASHING_WORKERS = int(os.environ.get("PASSWORD_HASHING_WORKERS", "2"))
+PASSWORD_HASHING_QUEUE_LIMIT = int(os.environ.get("PASSWORD_HASHING_QUEUE_LIMIT", "16"))
+
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASHING_WORKERS, thread_name_prefix="password-hashing")
+_slots = threading.BoundedSemaphore(PASSWORD_HASHING_WORKERS + PASSWORD_HASHING_QUEUE_LIMIT)
+
+wait_time = metrics.histogram("password_hashing_wait_seconds", "Time passwords waited for a free hashing worker.")
+exec_time = metrics.histogram("password_hashing_exec_seconds", "Time spent hashing or checking a password.")
+rejected = metrics.counter("password_hashing_rejected_total", "Requests rejected because the hashing queue was full.")
+
+
+class PasswordHashingBusy(ServiceUnavailable):
+    description = "There are too many login attempts at the moment. Please try again in a few seconds."
+
+
+# runs the function in the hashing pool and waits for its result
+def _run_in_pool(function, *args):
+    if not _slots.acquire(blocking=False):
+        rejected.inc()
+        raise PasswordHashingBusy()
+
+    queued = time.perf_counter()
+
+    def job():
+        started = time.perf_counter()
+        wait_time.observe(started - queued)
+
+        try:
+            return function(*args)
+        finally:
+            exec_time.observe(time.perf_counter() - started)
+
+    try:
+        with instrumentation.timed("bcrypt"):
+            return _executor.submit(job).result()
+    finally:
+        _slots.release()
+
+
+# hashes the password with bcrypt (with the cost from the password policy) and returns the hash as a string
+def hash_password(password):
+    salt = bcrypt.gensalt(rounds=password_policy.get_rounds())
+    hashed = _run_in_pool(bcrypt.hashpw, password.encode("utf-8"), salt)
+
+    return hashed.decode("utf-8")
+
+
+# checks the password against a bcrypt hash
+def check_password(password, password_hash):
+    return _run_in_pool(bcrypt.checkpw, password.encode("utf-8"), password_hash.encode("utf-8"))
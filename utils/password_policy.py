@@ -0,0 +1,90 @@
+import argparse
+import os
+import time
+
+import bcrypt
+
+
+# bcrypt cost (log2 of the number of rounds) used for new password hashes:
+# - BCRYPT_ROUNDS environment variable sets it for the whole deployment (app.yaml),
+# - BCRYPT_TARGET_MS environment variable picks the highest cost that hashes a password in about that many
+#   milliseconds on this instance (measured once per instance, see calibrate()), but never less than DEFAULT_ROUNDS.
+#   Instances may pick different costs, so prefer BCRYPT_ROUNDS (python -m utils.password_policy recommends a value),
+# - otherwise bcrypt's default is used.
+# The cost is a part of every bcrypt hash ("$2b$12$..."), so when it's raised, passwords are re-hashed with the new
+# cost on the next successful login (see needs_rehash()). Hashes are never re-hashed with a lower cost.
+DEFAULT_ROUNDS = 12
+MIN_ROUNDS = 10
+MAX_ROUNDS = 16
+
+_rounds = None
+
+
+# measures how long (in seconds) hashing a password with this cost takes (the fastest of a few tries)
+def measure(rounds, tries=3):
+    durations = []
+    for _ in range(tries):
+        started = time.perf_counter()
+        bcrypt.hashpw(b"calibration password", bcrypt.gensalt(rounds=rounds))
+        durations.append(time.perf_counter() - started)
+
+    return min(durations)
+
+
+# returns the highest cost (between MIN_ROUNDS and MAX_ROUNDS) whose hashing time doesn't exceed the target
+def calibrate(target_ms, min_rounds=MIN_ROUNDS, max_rounds=MAX_ROUNDS):
+    # every additional round doubles the hashing time, so measuring the cheapest cost is enough to estimate the others
+    duration_ms = measure(min_rounds) * 1000
+
+    rounds = min_rounds
+    while rounds < max_rounds and duration_ms * 2 <= target_ms:
+        rounds += 1
+        duration_ms *= 2
+
+    return rounds
+
+
+# returns the cost used for new password hashes
+def get_rounds():
+    global _rounds
+
+    if _rounds is None:
+        if os.environ.get("BCRYPT_ROUNDS"):
+            _rounds = int(os.environ["BCRYPT_ROUNDS"])
+        elif os.environ.get("BCRYPT_TARGET_MS"):
+            _rounds = calibrate(float(os.environ["BCRYPT_TARGET_MS"]), min_rounds=DEFAULT_ROUNDS)
+        else:
+            _rounds = DEFAULT_ROUNDS
+
+    return _rounds
+
+
+# reads the cost from a bcrypt hash ("$2b$12$...")
+def get_hash_rounds(password_hash):
+    try:
+        return int(password_hash.split("$")[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+# checks if the password hash was created with a lower cost than the current one
+def needs_rehash(password_hash):
+    rounds = get_hash_rounds(password_hash)
+
+    return rounds is None or rounds < get_rounds()
+
+
+# prints hashing times on this machine and the cost to use (python -m utils.password_policy --target-ms 250)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks bcrypt and recommends the BCRYPT_ROUNDS value.")
+    parser.add_argument("--target-ms", type=float, default=250, help="target hashing time in milliseconds")
+    args = parser.parse_args()
+
+    for cost in range(MIN_ROUNDS, MAX_ROUNDS + 1):
+        cost_ms = measure(cost, tries=1) * 1000
+        print("cost {0}: {1:.0f} ms".format(cost, cost_ms))
+
+        if cost_ms > args.target_ms * 4:
+            break
+
+    print("BCRYPT_ROUNDS={0}".format(calibrate(args.target_ms)))
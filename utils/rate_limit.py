@@ -0,0 +1,101 @@
+import logging
+import math
+import os
+import threading
+import time
+
+from werkzeug.exceptions import TooManyRequests
+
+from utils import metrics
+from utils.cache import LRUCache
+
+
+# Token buckets in front of the login and forgot password forms, per IP address and per e-mail address, so that
+# credential stuffing is rejected before any password hashing, Datastore reads or e-mails. Every limit is
+# (capacity, refill period in seconds): a bucket holds at most "capacity" requests and gets a new one every
+# period / capacity seconds.
+LIMITS = {
+    "login": {"ip": (20, 60), "email": (10, 600)},
+    "forgot_password": {"ip": (10, 3600), "email": (3, 3600)},
+}
+
+# "memory" keeps buckets on every instance separately, "datastore" shares them between all instances
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE", "memory")
+
+rejected = metrics.counter("rate_limit_rejected_total", "Requests rejected by the rate limit.")
+
+
+class RateLimited(TooManyRequests):
+    description = "Too many attempts. Please wait a moment and try again."
+
+
+class MemoryStore(object):
+    """Token buckets in the memory of this instance."""
+
+    def __init__(self, max_size=100000):
+        # buckets that haven't been used for an hour are full again anyway, so they can be dropped
+        self.buckets = LRUCache(max_size=max_size, ttl=3600)
+        self._lock = threading.Lock()
+
+    # takes one token from the bucket, returns (allowed, seconds until the next token)
+    def take(self, key, capacity, refill_rate):
+        with self._lock:
+            now = time.monotonic()
+            bucket = self.buckets.get(key)
+
+            if bucket:
+                tokens, updated = bucket
+                tokens = min(capacity, tokens + (now - updated) * refill_rate)
+            else:
+                tokens = capacity
+
+            if tokens < 1:
+                return False, (1 - tokens) / refill_rate
+
+            self.buckets.set(key, (tokens - 1, now))
+            return True, 0
+
+
+class DatastoreStore(object):
+    """Token buckets stored as RateLimitBucket entities, shared by all instances."""
+
+    def take(self, key, capacity, refill_rate):
+        from models.rate_limit_bucket import RateLimitBucket
+
+        try:
+            return RateLimitBucket.take(key, capacity, refill_rate)
+        except Exception as e:
+            # e.g. too much contention on the same bucket: the request is rejected
+            logging.warning("Rate limit bucket {0} could not be updated: {1}".format(key, e))
+            return False, 1
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+# returns the store shared by the whole instance (see RATE_LIMIT_STORE)
+def get_store():
+    global _store
+
+    with _store_lock:
+        if _store is None:
+            _store = DatastoreStore() if RATE_LIMIT_STORE == "datastore" else MemoryStore()
+
+    return _store
+
+
+# takes a token from every bucket of the action (e.g. check("login", ip=..., email=...)), raises RateLimited (429)
+# if one of them is empty
+def check(action, **values):
+    for name, (capacity, period) in LIMITS[action].items():
+        value = values.get(name)
+        if not value:
+            continue
+
+        key = "{0}:{1}:{2}".format(action, name, value.strip().lower())
+        allowed, retry_after = get_store().take(key, capacity, capacity / period)
+
+        if not allowed:
+            rejected.inc(action=action, limit=name)
+            raise RateLimited(retry_after=math.ceil(retry_after))
@@ -0,0 +1,109 @@
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from models.settings import Settings
+
+
+SENDGRID_API_URL = "https://api.sendgrid.com/v3/mail/send"
+MAX_PERSONALIZATIONS = 1000  # max. number of recipients (personalizations) per SendGrid request
+
+
+class SendGridSender(object):
+    """Sends e-mails via the SendGrid API over a pooled HTTP session (one per instance, see get_sender()).
+
+    Messages with the same sender, subject and content are sent in one request, with a personalization for every
+    recipient.
+    """
+
+    def __init__(self, pool_size=10, timeout=10):
+        self.timeout = timeout
+
+        self._api_key = None
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    # the SendGrid API key is read from settings only once (and again after SendGrid rejects it)
+    @property
+    def api_key(self):
+        with self._lock:
+            if not self._api_key:
+                setting = Settings.get_by_name("SendGrid-Mail")
+                self._api_key = setting.value if setting else None
+
+            return self._api_key
+
+    def _post(self, payload):
+        response = self.session.post(SENDGRID_API_URL, json=payload, timeout=self.timeout,
+                                     headers={"Authorization": "Bearer {0}".format(self.api_key)})
+
+        if response.status_code in (401, 403):
+            with self._lock:
+                self._api_key = None
+
+        return response
+
+    # sends the messages and returns a list with the result for every message: {"success": ..., "error": ...}
+    def send(self, messages):
+        results = [None] * len(messages)
+
+        # group messages with the same content
+        groups = {}
+        for index, message in enumerate(messages):
+            content = (message.get("sender_email"), message.get("email_subject"), message.get("email_body"),
+                       message.get("non_html_message"))
+            groups.setdefault(content, []).append(index)
+
+        for (sender_email, email_subject, email_body, non_html_message), indexes in groups.items():
+            contents = []
+            if non_html_message:
+                contents.append({"type": "text/plain", "value": non_html_message})  # text/plain has to be first
+            if email_body:
+                contents.append({"type": "text/html", "value": email_body})
+
+            for start in range(0, len(indexes), MAX_PERSONALIZATIONS):
+                chunk = indexes[start:start + MAX_PERSONALIZATIONS]
+
+                payload = {
+                    "personalizations": [{"to": [{"email": messages[index].get("recipient_email")}]}
+                                         for index in chunk],
+                    "from": {"email": sender_email},
+                    "subject": email_subject,
+                    "content": contents,
+                }
+
+                try:
+                    response = self._post(payload)
+                    success = 200 <= response.status_code < 300
+                    error = None if success else "{0}: {1}".format(response.status_code, response.text)
+                except Exception as e:
+                    success = False
+                    error = str(e)
+
+                if error:
+                    logging.error("SendGrid could not send {0} e-mail(s): {1}".format(len(chunk), error))
+
+                for index in chunk:
+                    results[index] = {"recipient_email": messages[index].get("recipient_email"),
+                                      "success": success, "error": error}
+
+        return results
+
+
+_sender = None
+_sender_lock = threading.Lock()
+
+
+# returns the sender shared by the whole instance
+def get_sender():
+    global _sender
+
+    with _sender_lock:
+        if _sender is None:
+            _sender = SendGridSender()
+
+    return _sender
@@ -0,0 +1,53 @@
+import base64
+import hashlib
+import hmac
+import logging
+import secrets
+
+from models.settings import Settings
+
+
+# used when the SECRET_KEY setting is missing (signed values are then only valid on this instance until it restarts)
+_fallback_key = secrets.token_bytes(32)
+_fallback_warned = False
+
+
+# the server secret (the SECRET_KEY setting, see README.md)
+def get_secret_key():
+    global _fallback_warned
+
+    setting = Settings.get_by_name("SECRET_KEY")
+
+    if setting and setting.value:
+        return setting.value.encode()
+
+    if not _fallback_warned:
+        logging.warning("The SECRET_KEY setting is missing, signed values are only valid on this instance.")
+        _fallback_warned = True
+
+    return _fallback_key
+
+
+def _signature(value, purpose):
+    # the purpose is a part of the signed message, so a value signed for one purpose isn't valid for another
+    digest = hmac.new(get_secret_key(), "{0}|{1}".format(purpose, value).encode(), hashlib.sha256).digest()
+
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+# returns "<value>.<signature>"
+def sign(value, purpose):
+    return "{0}.{1}".format(value, _signature(value, purpose))
+
+
+# returns the signed value or None if the signature is not valid
+def unsign(signed_value, purpose):
+    if not signed_value:
+        return None
+
+    value, separator, signature = signed_value.rpartition(".")
+
+    if not separator or not hmac.compare_digest(signature, _signature(value, purpose)):
+        return None
+
+    return value
@@ -1,18 +1,57 @@
 import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-from google.cloud import tasks_v2
+from flask import current_app
 
+from utils import instrumentation, local_task_queue
 from utils.environment import is_local
 
 
+# max. number of tasks enqueued at the same time by run_background_tasks
+MAX_PARALLEL_ENQUEUES = 8
+
+_client = None
+_client_lock = threading.Lock()
+_enqueue_executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_ENQUEUES, thread_name_prefix="enqueue-task")
+
+
+# returns the Cloud Tasks client shared by the whole instance (creating a client opens a new gRPC channel and
+# authenticates, which is too slow to do for every task)
+def get_tasks_client():
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            # imported here, because only production uses Cloud Tasks (and the import slows down every cold start)
+            from google.cloud import tasks_v2
+
+            # make sure you have Cloud Tasks API enabled via the Google Cloud Console
+            _client = tasks_v2.CloudTasksClient()
+
+    return _client
+
+
 def run_background_task(relative_path, payload, project=None, queue=None, location=None):
+    run_background_tasks(relative_path=relative_path, payloads=[payload], project=project, queue=queue,
+                         location=location)
+
+
+# enqueues one task for every payload (concurrently, at most MAX_PARALLEL_ENQUEUES at the same time)
+def run_background_tasks(relative_path, payloads, project=None, queue=None, location=None):
+    with instrumentation.timed("tasks"):
+        _enqueue_tasks(relative_path=relative_path, payloads=payloads, project=project, queue=queue,
+                       location=location)
+
+
+def _enqueue_tasks(relative_path, payloads, project=None, queue=None, location=None):
     if is_local():
-        if os.environ.get("TESTING") != "yes":  # pytest has issues with running requests
-            requests.post("http://localhost:8080{relative_path}".format(relative_path=relative_path),
-                          data=json.dumps(payload).encode(),
-                          headers={"Content-type": "application/octet-stream"})
+        # tasks run in this process, in the background (with the rate and retry settings from queue.yaml)
+        local_queue = local_task_queue.get_queue(current_app._get_current_object(), queue or "default")
+
+        for payload in payloads:
+            local_queue.add(relative_path, json.dumps(payload).encode())
     else:
         # production
         if not project:
@@ -24,18 +63,24 @@ def run_background_task(relative_path, payload, project=None, queue=None, locati
         if not location:
             location = "europe-west1"
 
-        # make sure you have Cloud Tasks API enabled via the Google Cloud Console
-        client = tasks_v2.CloudTasksClient()
+        client = get_tasks_client()
 
         # Construct the fully qualified queue name.
         parent = client.queue_path(project, location, queue)
 
-        task = {
-            'app_engine_http_request': {
-                'http_method': 'POST',
-                'relative_uri': relative_path,
-                'body': json.dumps(payload).encode(),
+        def create_task(payload):
+            task = {
+                'app_engine_http_request': {
+                    'http_method': 'POST',
+                    'relative_uri': relative_path,
+                    'body': json.dumps(payload).encode(),
+                }
             }
-        }
 
-        client.create_task(parent, task)
+            return client.create_task(parent=parent, task=task)
+
+        if len(payloads) == 1:
+            create_task(payloads[0])
+        else:
+            # list() waits for all tasks and raises the first error (if any)
+            list(_enqueue_executor.map(create_task, payloads))